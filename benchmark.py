@@ -0,0 +1,385 @@
+import argparse
+import json
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from contextlib import redirect_stdout
+from datetime import datetime, timezone
+from pathlib import Path
+
+from preview_builder import PreviewBuilder
+
+# Screen-recording shaped sources: native capture sizes of current iPhone and iPad models
+FIXTURE_DEVICES = {
+    'iphone': (1179, 2556),
+    'ipad': (1640, 2360),
+}
+
+# (duration seconds, codec, GOP frames); --quick keeps only the first entry
+FIXTURE_VARIANTS = [
+    (5, 'h264', 60),
+    (60, 'h264', 60),
+    (60, 'h264', 600),
+    (60, 'hevc', 600),
+    (120, 'h264', 120),
+]
+
+FIXTURE_ENCODERS = {'h264': 'libx264', 'hevc': 'libx265'}
+
+# Capture rates of ProMotion screen recordings, for the filter-order benchmark
+FILTER_FIXTURE_RATES = (60, 120)
+
+
+def _time_call(func, repeat):
+    """Best wall time of `repeat` calls, in seconds"""
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def _git_commit():
+    try:
+        result = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                                check=True, cwd=Path(__file__).parent)
+        return result.stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def generate_video_fixture(path, size, duration, codec, gop, fps=60):
+    """Render a synthetic recording from FFmpeg's testsrc2 source, unless it already exists"""
+    if path.exists():
+        return path
+    width, height = size
+    temp_path = path.with_name(f'{path.stem}.tmp{path.suffix}')
+    ffmpeg_cmd = [
+        'ffmpeg', '-y', '-v', 'error',
+        '-f', 'lavfi',
+        '-i', f'testsrc2=size={width}x{height}:rate={fps}:duration={duration}',
+        '-c:v', FIXTURE_ENCODERS[codec],
+        '-g', str(gop),
+        '-pix_fmt', 'yuv420p',
+        '-preset', 'ultrafast',
+    ]
+    if codec == 'hevc':
+        ffmpeg_cmd += ['-tag:v', 'hvc1']  # QuickTime-compatible HEVC tag, as iOS records
+    ffmpeg_cmd.append(str(temp_path))
+    subprocess.run(ffmpeg_cmd, check=True)
+    temp_path.rename(path)
+    return path
+
+
+def generate_audio_fixture(path, duration):
+    """Render a sine tone, unless it already exists"""
+    if path.exists():
+        return path
+    temp_path = path.with_name(f'{path.stem}.tmp{path.suffix}')
+    ffmpeg_cmd = [
+        'ffmpeg', '-y', '-v', 'error',
+        '-f', 'lavfi',
+        '-i', f'sine=frequency=440:sample_rate=44100:duration={duration}',
+        '-c:a', 'libmp3lame',
+        '-b:a', '192k',
+        str(temp_path)
+    ]
+    subprocess.run(ffmpeg_cmd, check=True)
+    temp_path.rename(path)
+    return path
+
+
+def generate_fixtures(fixtures_dir, quick=False):
+    """Create (or reuse) the synthetic fixture set, returning video fixtures and the audio track"""
+    fixtures_dir = Path(fixtures_dir)
+    fixtures_dir.mkdir(parents=True, exist_ok=True)
+    variants = FIXTURE_VARIANTS[:1] if quick else FIXTURE_VARIANTS
+
+    videos = []
+    for device_type, size in FIXTURE_DEVICES.items():
+        for duration, codec, gop in variants:
+            name = f'{device_type}_{duration}s_{codec}_gop{gop}.mp4'
+            print(f"Preparing fixture {name}")
+            videos.append({
+                'device_type': device_type,
+                'duration': duration,
+                'codec': codec,
+                'gop': gop,
+                'path': generate_video_fixture(fixtures_dir / name, size, duration, codec, gop),
+            })
+    audio = generate_audio_fixture(fixtures_dir / 'background_12s.mp3', 12)
+    return videos, audio
+
+
+def _infer_device(info):
+    """'ipad' for roughly 3:4 recordings, 'iphone' for the taller phone aspect ratios"""
+    width, height = info.get('width') or 0, info.get('height') or 0
+    if not width or not height:
+        return 'iphone'
+    return 'ipad' if min(width, height) / max(width, height) > 0.6 else 'iphone'
+
+
+def bench_screenshots(video_paths, repeat, device_type=None):
+    """Compare sequential decoding against keyframe-aware seeking for screenshot capture
+
+    Each recording is resized to its device's screenshot size; the device is inferred from
+    the aspect ratio unless `device_type` is given.
+    """
+    results = []
+    with tempfile.TemporaryDirectory() as work_dir:
+        builder = PreviewBuilder(work_dir)
+        screenshots_dir = Path(work_dir) / 'screenshots'
+        screenshots_dir.mkdir()
+
+        for video_path in video_paths:
+            info = builder._probe(video_path)
+            keyframes = builder._probe_keyframes(video_path)
+            frame_positions = builder._screenshot_positions(video_path)
+            device = device_type or _infer_device(info)
+
+            timings = {}
+            for strategy in ('sequential', 'seek'):
+                builder.screenshot_strategy = strategy
+                timings[strategy] = _time_call(
+                    lambda: builder._capture_screenshots(str(video_path), screenshots_dir, device), repeat)
+
+            builder.screenshot_strategy = 'auto'
+            auto_choice = builder._choose_screenshot_strategy(video_path, frame_positions)
+            winner = min(timings, key=timings.get)
+            results.append({
+                'video': str(video_path),
+                'device': device,
+                'duration': info['duration'],
+                'frame_count': info['frame_count'],
+                'keyframes': len(keyframes),
+                'average_gop': info['frame_count'] / len(keyframes),
+                'predicted_frames': {
+                    'sequential': frame_positions[-1] + 1,
+                    'seek': builder._plan_seek_cost(frame_positions, keyframes),
+                },
+                'seconds': timings,
+                'winner': winner,
+                'auto_choice': auto_choice,
+                'auto_correct': auto_choice == winner,
+            })
+    return results
+
+
+def bench_suite(fixtures_dir, repeat, quick=False):
+    """Run each stage in isolation and the full pipeline on every synthetic fixture"""
+    videos, audio = generate_fixtures(fixtures_dir, quick)
+    results = []
+    with tempfile.TemporaryDirectory() as work_root:
+        # Isolated stages each start from an empty cache directory so nothing is reused
+        def cold_builder():
+            return PreviewBuilder(tempfile.mkdtemp(dir=work_root), use_build_cache=False)
+
+        for fixture in videos:
+            video_path, device_type = fixture['path'], fixture['device_type']
+            print(f"\nBenchmarking {video_path.name}")
+            stages = {
+                'probe': _time_call(lambda: cold_builder()._probe(video_path), repeat),
+                'probe_keyframes': _time_call(lambda: cold_builder()._probe_keyframes(video_path), repeat),
+                'prepare_audio': _time_call(lambda: cold_builder()._prepare_audio(audio), repeat),
+            }
+
+            builder = cold_builder()
+            screenshots_dir = builder.output_dir / 'screenshots'
+            screenshots_dir.mkdir()
+            stages['screenshots'] = _time_call(
+                lambda: builder._capture_screenshots(str(video_path), screenshots_dir, device_type), repeat)
+
+            # Full pipeline, with the per-stage breakdown from the builder's own run report
+            pipeline_seconds = []
+            pipeline_summary = None
+            for _ in range(repeat):
+                builder = cold_builder()
+                start = time.perf_counter()
+                builder.process_video(video_path, audio, device_type)
+                pipeline_seconds.append(time.perf_counter() - start)
+                pipeline_summary = builder.report.summary()
+
+            results.append({
+                'fixture': video_path.name,
+                'device_type': device_type,
+                'duration': fixture['duration'],
+                'codec': fixture['codec'],
+                'gop': fixture['gop'],
+                'stage_seconds': stages,
+                'pipeline_seconds': min(pipeline_seconds),
+                'pipeline_stages': pipeline_summary,
+            })
+    return results
+
+
+def bench_filters(fixtures_dir, repeat):
+    """Filter time of scaling every source frame then dropping to 30 fps, versus dropping first"""
+    fixtures_dir = Path(fixtures_dir)
+    fixtures_dir.mkdir(parents=True, exist_ok=True)
+    results = []
+    with tempfile.TemporaryDirectory() as work_dir:
+        builder = PreviewBuilder(work_dir)
+        width, height = builder.iphone_video_resolution
+        for rate in FILTER_FIXTURE_RATES:
+            name = f'iphone_30s_h264_{rate}fps.mp4'
+            print(f"Preparing fixture {name}")
+            video_path = generate_video_fixture(fixtures_dir / name, FIXTURE_DEVICES['iphone'], 30, 'h264', rate,
+                                                fps=rate)
+            info = builder._probe(video_path)
+            chains = {
+                # Scale every decoded frame, then let the output -r drop the surplus
+                'scale_then_drop': ','.join(builder._scale_filters(info, width, height)) or 'null',
+                'drop_then_scale': builder._preview_filter(info, width, height),
+            }
+            # Decode and filter only, so the difference is filter time
+            timings = {
+                layout: _time_call(lambda: subprocess.run(
+                    ['ffmpeg', '-v', 'error', '-i', str(video_path), '-vf', chain, '-r', '30', '-f', 'null', '-'],
+                    check=True), repeat)
+                for layout, chain in chains.items()
+            }
+            results.append({
+                'fixture': name,
+                'source_fps': info['fps'],
+                'filters': chains,
+                'seconds': timings,
+                'speedup': timings['scale_then_drop'] / timings['drop_then_scale'],
+            })
+    return results
+
+
+def _time_cli(args, repeat):
+    """Best wall time of running preview_builder.py as a fresh interpreter"""
+    script = str(Path(__file__).parent / 'preview_builder.py')
+    return _time_call(lambda: subprocess.run([sys.executable, script] + args, check=True,
+                                             stdout=subprocess.DEVNULL), repeat)
+
+
+def bench_startup(fixtures_dir, repeat, max_help_seconds, max_cached_seconds):
+    """Time CLI startup for --help and for a run where every device is a build cache hit"""
+    check_imports = ("import sys, preview_builder; "
+                     "print(','.join(name for name in ('cv2', 'numpy') if name in sys.modules))")
+    result = subprocess.run([sys.executable, '-c', check_imports], capture_output=True, text=True, check=True,
+                            cwd=Path(__file__).parent)
+    heavy_imports = [name for name in result.stdout.strip().split(',') if name]
+
+    videos, audio = generate_fixtures(fixtures_dir, quick=True)
+    inputs = {fixture['device_type']: str(fixture['path']) for fixture in videos}
+    with tempfile.TemporaryDirectory() as output_dir:
+        run_args = ['--iphone', inputs['iphone'], '--ipad', inputs['ipad'], '--audio', str(audio),
+                    '--output', output_dir, '--workers', '1']
+        # The first run builds everything; later runs should only hash-check and exit
+        subprocess.run([sys.executable, str(Path(__file__).parent / 'preview_builder.py')] + run_args,
+                       check=True, stdout=subprocess.DEVNULL)
+        cached_seconds = _time_cli(run_args, repeat)
+
+    help_seconds = _time_cli(['--help'], repeat)
+    return [{
+        'heavy_imports_at_startup': heavy_imports,
+        'help_seconds': help_seconds,
+        'cached_run_seconds': cached_seconds,
+        'targets': {'help_seconds': max_help_seconds, 'cached_run_seconds': max_cached_seconds},
+        'passed': not heavy_imports and help_seconds <= max_help_seconds and cached_seconds <= max_cached_seconds,
+    }]
+
+
+def compare_results(baseline_path, candidate_path):
+    """Print per-fixture timing changes between two suite result files"""
+    with open(baseline_path) as f:
+        baseline = {result['fixture']: result for result in json.load(f)['results']}
+    with open(candidate_path) as f:
+        candidate = json.load(f)['results']
+
+    rows = []
+    for result in candidate:
+        previous = baseline.get(result['fixture'])
+        if previous is None:
+            continue
+        timings = dict(result['stage_seconds'], pipeline=result['pipeline_seconds'])
+        previous_timings = dict(previous['stage_seconds'], pipeline=previous['pipeline_seconds'])
+        for stage, seconds in timings.items():
+            if stage in previous_timings and previous_timings[stage]:
+                change = (seconds - previous_timings[stage]) / previous_timings[stage] * 100
+                rows.append((result['fixture'], stage, previous_timings[stage], seconds, change))
+
+    for fixture, stage, before, after, change in rows:
+        print(f"{fixture:40} {stage:16} {before:9.3f}s -> {after:9.3f}s  {change:+6.1f}%")
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark PreviewBuilder stages')
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+
+    screenshots = subparsers.add_parser('screenshots', help='Compare screenshot decoding strategies')
+    screenshots.add_argument('videos', nargs='+', help='Recordings to benchmark (e.g. typical 60-120s captures)')
+    screenshots.add_argument('--repeat', type=int, default=3, help='Runs per strategy, best time is kept (default: 3)')
+    screenshots.add_argument('--device', choices=['iphone', 'ipad'],
+                             help='Screenshot size to resize to (default: inferred from each recording\'s aspect ratio)')
+    screenshots.add_argument('--output', help='Write JSON results to this file instead of stdout')
+
+    suite = subparsers.add_parser('suite', help='Run stages and the full pipeline on synthetic fixtures')
+    suite.add_argument('--fixtures', default='bench_fixtures',
+                       help='Directory for generated fixtures, reused between runs (default: bench_fixtures)')
+    suite.add_argument('--repeat', type=int, default=1, help='Runs per measurement, best time is kept (default: 1)')
+    suite.add_argument('--quick', action='store_true', help='Only the shortest fixture per device')
+    suite.add_argument('--output', help='Write JSON results to this file instead of stdout')
+
+    startup = subparsers.add_parser('startup', help='Check CLI startup time for --help and cache-hit runs')
+    startup.add_argument('--fixtures', default='bench_fixtures',
+                         help='Directory for generated fixtures, reused between runs (default: bench_fixtures)')
+    startup.add_argument('--repeat', type=int, default=5, help='Runs per measurement, best time is kept (default: 5)')
+    startup.add_argument('--max-help', type=float, default=0.3,
+                         help='Fail if --help takes longer than this many seconds (default: 0.3)')
+    startup.add_argument('--max-cached', type=float, default=1.0,
+                         help='Fail if a fully cached run takes longer than this many seconds (default: 1.0)')
+    startup.add_argument('--output', help='Write JSON results to this file instead of stdout')
+
+    filters = subparsers.add_parser('filters', help='Compare scaling before and after the 30 fps conversion')
+    filters.add_argument('--fixtures', default='bench_fixtures',
+                         help='Directory for generated fixtures, reused between runs (default: bench_fixtures)')
+    filters.add_argument('--repeat', type=int, default=3, help='Runs per layout, best time is kept (default: 3)')
+    filters.add_argument('--output', help='Write JSON results to this file instead of stdout')
+
+    compare = subparsers.add_parser('compare', help='Compare two suite result files')
+    compare.add_argument('baseline', help='Results from the reference commit')
+    compare.add_argument('candidate', help='Results from the commit under test')
+
+    args = parser.parse_args()
+
+    if args.benchmark == 'compare':
+        compare_results(args.baseline, args.candidate)
+        return 0
+
+    # Without --output the results go to stdout, so keep progress messages off it
+    with redirect_stdout(sys.stdout if args.output else sys.stderr):
+        if args.benchmark == 'suite':
+            results = bench_suite(Path(args.fixtures), args.repeat, args.quick)
+        elif args.benchmark == 'filters':
+            results = bench_filters(Path(args.fixtures), args.repeat)
+        elif args.benchmark == 'startup':
+            results = bench_startup(Path(args.fixtures), args.repeat, args.max_help, args.max_cached)
+        else:
+            results = bench_screenshots(args.videos, args.repeat, args.device)
+
+    report = json.dumps({
+        'benchmark': args.benchmark,
+        'commit': _git_commit(),
+        'created_at': datetime.now(timezone.utc).isoformat(),
+        'machine': platform.platform(),
+        'results': results,
+    }, indent=2, default=str)
+    if args.output:
+        Path(args.output).write_text(report)
+        print(f"Wrote benchmark results to {args.output}")
+    else:
+        print(report)
+    # Startup targets act as an assertion so CI can gate on them
+    return 0 if all(result.get('passed', True) for result in results) else 1
+
+
+if __name__ == "__main__":
+    exit(main())
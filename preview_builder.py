@@ -1,13 +1,261 @@
 import subprocess
-import cv2
 import os
-import numpy as np
+import math
 from pathlib import Path
 import argparse
+import asyncio
 import json
+import hashlib
+import shutil
+import bisect
+from fractions import Fraction
+import sys
+import threading
+import tempfile
+import time
+import uuid
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import fcntl
+except ImportError:  # Windows: cache files are still replaced atomically, just without locking
+    fcntl = None
+
+try:
+    import resource
+except ImportError:  # Windows: stages are reported without CPU time and peak RSS
+    resource = None
+
+# Bump when the shape of probe results changes so stale cache entries are ignored
+PROBE_CACHE_VERSION = 3
+
+# Bump when the build manifest layout or the meaning of its build keys changes
+MANIFEST_VERSION = 2
+JOURNAL_VERSION = 1
+
+# Scaled frames the loop filter may hold to repeat a short clip without decoding it again
+LOOP_MEMORY_BUDGET = 512 * 1024 * 1024
+
+# Upper end of the App Store's 10-12 Mbps preview bit rate; compliant sources above it are re-encoded
+STREAM_COPY_MAX_BITRATE = 12000000
+
+# Decoder flush/reset cost of one seek, expressed in decoded frames
+SEEK_COST_FRAMES = 10
+
+# Rate control and speed settings per encoding profile; every profile keeps the App Store
+# format (H.264 High Profile Level 4.0 at 30 fps)
+ENCODING_PROFILES = {
+    # Quick look while iterating: constant quality at the fastest preset, not for submission
+    'draft': {'preset': 'ultrafast', 'crf': 23},
+    # Settings required by the App Store
+    'final': {
+        'bitrate': '11M',  # Target bit rate 10-12 Mbps
+        'maxrate': '220M',  # VBR max rate ~220 Mbps
+        'bufsize': '440M',  # VBR buffer size
+        'preset': 'slow',  # Slower preset for better quality
+    },
+    # Compliant bitrate with a two-pass encode for the most even quality
+    'archival': {'bitrate': '11M', 'maxrate': '220M', 'bufsize': '440M', 'preset': 'slower', 'passes': 2},
+}
+
+def plan_timeline(source_duration, required_duration, offset=0.0):
+    """Work out how a source clip fills `required_duration`, starting `offset` seconds into it
+
+    Returns the number of plays (full or partial) of the source, the matching -stream_loop
+    value (which counts extra plays), and how much of the final play is used. Unlike
+    rounding up the ratio and adding it as extra loops, this never schedules a play that
+    the output would discard.
+    """
+    if source_duration <= 0:
+        raise ValueError(f'source duration must be positive, got {source_duration}')
+    # Tolerate probe rounding so an exact multiple doesn't schedule an extra play
+    span = offset + required_duration
+    plays = max(1, math.ceil(span / source_duration - 1e-6))
+    return {
+        'plays': plays,
+        'extra_loops': plays - 1,
+        'final_play_seconds': span - (plays - 1) * source_duration,
+    }
+
+def _bitrate_bps(value):
+    """Bits per second from an FFmpeg-style rate such as '256k' or '11M'"""
+    value = str(value)
+    scale = {'k': 1000, 'M': 1000000}.get(value[-1:], 1)
+    return int(float(value[:-1] if scale > 1 else value) * scale)
+
+def _progress_position(progress):
+    """(frame, out_time) of a progress snapshot, for telling real progress from repeated reports"""
+    return progress['frame'], progress['out_time'] or 0.0
+
+def _process_running(pid):
+    """Whether a process with this pid exists; assumed to on Windows, where the check would kill it"""
+    if os.name == 'nt' or pid == os.getpid():
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+class EncodeStalledError(RuntimeError):
+    """Raised when the stall watchdog kills an FFmpeg process that stopped making progress"""
+
+class _StallWatchdog:
+    """Kill an FFmpeg process whose progress stops or whose speed stays below a threshold"""
+
+    def __init__(self, process, min_speed, timeout):
+        self.process = process
+        self.min_speed = min_speed
+        self.timeout = timeout
+        self.stalled = None  # Reason the process was killed
+        self._last_update = time.monotonic()
+        self._last_position = (0, 0.0)
+        self._slow_since = None
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._watch, daemon=True)
+        self._thread.start()
+
+    def update(self, progress):
+        now = time.monotonic()
+        # FFmpeg keeps sending report blocks while stuck; only advancing output counts
+        position = _progress_position(progress)
+        if position > self._last_position:
+            self._last_position = position
+            self._last_update = now
+        speed = progress['speed']
+        if self.min_speed and speed is not None and speed < self.min_speed:
+            self._slow_since = self._slow_since or now
+        else:
+            self._slow_since = None
+
+    def _watch(self):
+        while not self._stopped.wait(1.0):
+            now = time.monotonic()
+            if now - self._last_update > self.timeout:
+                self.stalled = f'no progress for {self.timeout:.0f}s'
+            elif self._slow_since is not None and now - self._slow_since > self.timeout:
+                self.stalled = f'speed below {self.min_speed}x for {self.timeout:.0f}s'
+            if self.stalled:
+                self.process.kill()
+                return
+
+    def stop(self):
+        self._stopped.set()
+        self._thread.join()
+
+class RunReport:
+    """Per-stage wall time, CPU time, peak RSS and bytes written for one run"""
+
+    def __init__(self):
+        self.started_at = time.time()
+        self.stages = []
+        self.error = None  # Why the run failed, if it did
+        self._lock = threading.Lock()
+
+    def _usage(self):
+        """CPU seconds of this process and its finished children, and the peak RSS in bytes"""
+        if resource is None:
+            return None, None
+        own = resource.getrusage(resource.RUSAGE_SELF)
+        children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        cpu = own.ru_utime + own.ru_stime + children.ru_utime + children.ru_stime
+        # ru_maxrss is bytes on macOS and kilobytes elsewhere
+        scale = 1 if sys.platform == 'darwin' else 1024
+        return cpu, max(own.ru_maxrss, children.ru_maxrss) * scale
+
+    @contextmanager
+    def stage(self, name, outputs=(), **details):
+        """Time a stage; `outputs` are measured when it ends to count bytes written
+
+        CPU time covers the whole process (including FFmpeg children once they exit), so
+        stages that run concurrently each see the others' work.
+        """
+        record = {'name': name, **details, 'pid': os.getpid(), 'tid': threading.get_ident(),
+                  'start': time.time()}
+        cpu_start, _ = self._usage()
+        wall_start = time.perf_counter()
+        try:
+            yield record
+        except BaseException as e:
+            record['error'] = f'{type(e).__name__}: {e}'
+            raise
+        finally:
+            record['wall_seconds'] = time.perf_counter() - wall_start
+            cpu_end, peak_rss = self._usage()
+            record['cpu_seconds'] = cpu_end - cpu_start if cpu_end is not None else None
+            record['peak_rss_bytes'] = peak_rss
+            record['bytes_written'] = sum(os.path.getsize(path) for path in outputs if os.path.isfile(path))
+            with self._lock:
+                self.stages.append(record)
+
+    def timed(self, name, iterable, **details):
+        """Yield from `iterable`, recording the time spent producing each item as a stage"""
+        iterator = iter(iterable)
+        while True:
+            exhausted = False
+            with self.stage(name, **details) as record:
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    exhausted = True
+            if exhausted:
+                # The call that found the end produced nothing; don't report it as a stage
+                with self._lock:
+                    self.stages[:] = [stage for stage in self.stages if stage is not record]
+                return
+            yield item
+
+    def summary(self):
+        """Totals per stage name"""
+        totals = {}
+        for record in self.stages:
+            total = totals.setdefault(record['name'], {'count': 0, 'wall_seconds': 0.0, 'cpu_seconds': 0.0,
+                                                       'bytes_written': 0})
+            total['count'] += 1
+            total['wall_seconds'] += record['wall_seconds']
+            total['cpu_seconds'] += record['cpu_seconds'] or 0.0
+            total['bytes_written'] += record['bytes_written']
+        return totals
+
+    def write_json(self, path):
+        report = {
+            'started_at': datetime.fromtimestamp(self.started_at, timezone.utc).isoformat(),
+            'total_seconds': time.time() - self.started_at,
+            'error': self.error,
+            'summary': self.summary(),
+            'stages': sorted(self.stages, key=lambda record: record['start']),
+        }
+        with open(path, 'w') as f:
+            json.dump(report, f, indent=2, default=str)
+
+    def write_chrome_trace(self, path):
+        """Write stages as Chrome trace events (load in chrome://tracing or Perfetto)"""
+        events = []
+        for record in self.stages:
+            events.append({
+                'name': record['name'],
+                'cat': 'preview_builder',
+                'ph': 'X',
+                'ts': (record['start'] - self.started_at) * 1e6,
+                'dur': record['wall_seconds'] * 1e6,
+                'pid': record['pid'],
+                'tid': record['tid'],
+                'args': {key: value for key, value in record.items()
+                         if key not in ('name', 'start', 'pid', 'tid')},
+            })
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms', 'otherData': {'error': self.error}}, f,
+                      default=str)
 
 class PreviewBuilder:
-    def __init__(self, output_dir):
+    def __init__(self, output_dir, threads=None, screenshot_strategy='auto', single_pass=False,
+                 screenshot_workers=None, use_build_cache=True, chunks=1, progress_callback=None,
+                 min_speed=None, stall_timeout=None, profile='final', two_pass=False, bitrate=None,
+                 dedupe_frames=False, loop_memory_budget=LOOP_MEMORY_BUDGET):
         # Video preview resolutions (for App Store)
         self.iphone_video_resolution = (886, 1920)
         self.ipad_video_resolution = (1200, 1600)
@@ -16,30 +264,778 @@ class PreviewBuilder:
         self.iphone_screenshot_resolution = (1320, 2868)  # Higher resolution for screenshots
         self.ipad_screenshot_resolution = (2064, 2752)    # Higher resolution for screenshots
         
+        # H.264 format required by the App Store, with the named profile's rate control
+        if profile not in ENCODING_PROFILES:
+            raise ValueError(f"Unknown encoding profile {profile!r} (choose from {', '.join(ENCODING_PROFILES)})")
+        self.profile = profile
+        self.video_encoding = {
+            'codec': 'libx264',
+            'profile': 'high',
+            'level': '4.0',
+            'fps': 30,
+        }
+        self.video_encoding.update(ENCODING_PROFILES[profile])
+        self.bitrate = bitrate  # Explicit target bit rate; also caps which sources are stream-copied
+        if bitrate:
+            self.video_encoding.pop('crf', None)
+            self.video_encoding['bitrate'] = bitrate
+        if two_pass:
+            if 'crf' in self.video_encoding:
+                raise ValueError(f"Two-pass encoding needs a target bitrate; the {profile} profile uses constant quality")
+            self.video_encoding['passes'] = 2
+        self.audio_encoding = {'codec': 'aac', 'bitrate': '256k', 'channels': 2, 'sample_rate': 48000}
+
         self.required_duration = 30  # 30 seconds preview
         self.screenshot_count = 6  # Reduce screenshot count proportionally
         self.output_dir = Path(output_dir)
         self.output_dir.mkdir(exist_ok=True)
+        self.threads = threads  # Per-job CPU thread budget (None lets FFmpeg/OpenCV decide)
+        self.cache_dir = self.output_dir / '.cache'  # Intermediate artifacts shared between devices and runs
+        self._prepared_audio = {}
+        self._probe_memo = None  # Loaded lazily from the on-disk probe cache
+        self.screenshot_strategy = screenshot_strategy  # 'auto', 'sequential' or 'seek'
+        self.single_pass = single_pass  # Take screenshots inside the preview encode's decode
+        self.screenshot_workers = screenshot_workers  # Resize/encode threads (None uses the thread budget)
+        self.use_build_cache = use_build_cache  # Skip devices whose inputs and settings are unchanged
+        self.chunks = chunks  # Parallel segments per preview encode (1 encodes in a single process)
+        self.report = RunReport()  # Stage timings for the run
+        self.progress_callback = progress_callback  # Called with each FFmpeg progress snapshot
+        self.min_speed = min_speed  # Kill encodes slower than this realtime factor...
+        self.stall_timeout = stall_timeout  # ...or silent for this many seconds (None disables)
+        self.dedupe_frames = dedupe_frames  # Only scale frames that differ from the previous one
+        self.loop_memory_budget = loop_memory_budget  # Bytes of scaled frames looped in memory (0 disables)
 
-    def _get_audio_duration(self, audio_path):
-        """Get audio duration using FFprobe"""
-        cmd = [
+    @contextmanager
+    def _locked(self, name):
+        """Serialize read-modify-write of shared cache files across processes"""
+        self.cache_dir.mkdir(exist_ok=True)
+        with open(self.cache_dir / f'{name}.lock', 'w') as lock_file:
+            if fcntl:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                if fcntl:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _temp_path(self, path, tag=None):
+        """Sibling name an artifact is written to before being atomically renamed into place
+
+        Each call gets a fresh `<pid>-<random>` tag unless one is passed in, so concurrent
+        writers of the same artifact, in this process or another, never share a temp file.
+        """
+        path = Path(path)
+        tag = tag or f'{os.getpid()}-{uuid.uuid4().hex[:8]}'
+        return path.with_name(f'{path.stem}.{tag}.tmp{path.suffix}')
+
+    def _remove_stale_temps(self, paths):
+        """Delete temp files left by processes that are no longer running"""
+        for path in paths:
+            pid = path.name.split('.tmp')[0].rsplit('.', 1)[-1].split('-')[0]
+            if pid.isdigit() and not _process_running(int(pid)):
+                path.unlink()
+
+    def _write_json(self, path, data):
+        """Write JSON to a temporary file and atomically swap it into place"""
+        temp_path = self._temp_path(path)
+        with open(temp_path, 'w') as f:
+            json.dump(data, f, indent=2)
+        os.replace(temp_path, path)
+
+    def _probe_cache_path(self):
+        return self.cache_dir / 'probe.json'
+
+    def _load_probe_cache(self):
+        """Read persisted probe results, ignoring a missing, corrupt or outdated cache"""
+        try:
+            with open(self._probe_cache_path()) as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return {}
+        if data.get('version') != PROBE_CACHE_VERSION:
+            return {}
+        return data.get('entries', {})
+
+    def _save_probe_cache(self, key, info):
+        # Merge with whatever other processes persisted since we loaded, then swap in atomically
+        with self._locked('probe'):
+            entries = self._load_probe_cache()
+            entries[key] = info
+            self._write_json(self._probe_cache_path(), {'version': PROBE_CACHE_VERSION, 'entries': entries})
+
+    def _probe_key(self, media_path, kind):
+        media_path = Path(media_path).resolve()
+        stat = media_path.stat()
+        return f'{media_path}:{stat.st_size}:{stat.st_mtime_ns}:{kind}'
+
+    def _remembered_probe(self, key):
+        if self._probe_memo is None:
+            self._probe_memo = self._load_probe_cache()
+        return self._probe_memo.get(key)
+
+    def _remember_probe(self, key, info):
+        self._probe_memo[key] = info
+        self._save_probe_cache(key, info)
+
+    def _cached_probe(self, media_path, kind, run_probe):
+        """Memoize a probe result in-process and on disk, keyed by path, size, mtime and kind"""
+        key = self._probe_key(media_path, kind)
+        info = self._remembered_probe(key)
+        if info is None:
+            info = run_probe(Path(media_path).resolve())
+            self._remember_probe(key, info)
+        return info
+
+    def _probe(self, media_path):
+        """Get duration, frame count, fps, resolution, codec and rotation using a single FFprobe call"""
+        return self._cached_probe(media_path, 'streams', self._run_stream_probe)
+
+    def _stream_probe_cmd(self, media_path):
+        return [
             'ffprobe',
             '-v', 'error',
-            '-show_entries', 'format=duration',
+            '-show_format',
+            '-show_streams',
             '-of', 'json',
-            str(audio_path)
+            str(media_path)
         ]
-        
-        result = subprocess.run(cmd, capture_output=True, text=True)
-        data = json.loads(result.stdout)
-        return float(data['format']['duration'])
 
-    def process_video(self, input_video, audio_file, device_type='iphone'):
+    def _run_stream_probe(self, media_path):
+        result = subprocess.run(self._stream_probe_cmd(media_path), capture_output=True, text=True, check=True)
+        return self._parse_probe(json.loads(result.stdout))
+
+    def _probe_keyframes(self, video_path):
+        """Get the frame indices of the video's keyframes (demux only, no decoding)"""
+        return self._cached_probe(video_path, 'keyframes', self._run_keyframe_probe)
+
+    def _keyframe_probe_cmd(self, video_path):
+        return [
+            'ffprobe',
+            '-v', 'error',
+            '-select_streams', 'v:0',
+            '-show_entries', 'packet=pts_time,flags:stream=start_time',
+            '-of', 'json',
+            str(video_path)
+        ]
+
+    def _run_keyframe_probe(self, video_path):
+        result = subprocess.run(self._keyframe_probe_cmd(video_path), capture_output=True, text=True, check=True)
+        return self._parse_keyframes(json.loads(result.stdout), self._probe(video_path)['fps'])
+
+    def _parse_keyframes(self, data, fps):
+        """Convert keyframe packet timestamps into frame indices"""
+        fps = fps or 30
+        streams = data.get('streams') or [{}]
+        start_time = float(streams[0].get('start_time') or 0)
+        keyframes = set()
+        for packet in data.get('packets', []):
+            if 'K' in packet.get('flags', '') and packet.get('pts_time') not in (None, 'N/A'):
+                keyframes.add(max(0, int(round((float(packet['pts_time']) - start_time) * fps))))
+        keyframes.add(0)
+        return sorted(keyframes)
+
+    def _parse_probe(self, data):
+        """Flatten FFprobe JSON into the metadata the pipeline needs"""
+        streams = data.get('streams', [])
+        # Cover art in audio files shows up as a video stream, so skip attached pictures
+        video = next((st for st in streams if st.get('codec_type') == 'video'
+                      and not st.get('disposition', {}).get('attached_pic')), None)
+        audio = next((st for st in streams if st.get('codec_type') == 'audio'), None)
+
+        duration = float(data.get('format', {}).get('duration') or 0)
+        info = {
+            'duration': duration,
+            'codec': None,
+            'width': None,
+            'height': None,
+            'fps': None,
+            'frame_count': None,
+            'rotation': 0,
+            'profile': None,
+            'level': None,
+            'pix_fmt': None,
+            'bit_rate': None,
+            'audio_codec': audio.get('codec_name') if audio else None,
+            'sample_rate': int(audio['sample_rate']) if audio and audio.get('sample_rate') else None,
+            'channels': audio.get('channels') if audio else None,
+            'audio_bit_rate': int(audio['bit_rate']) if audio and audio.get('bit_rate') else None,
+        }
+        if video is None:
+            return info
+
+        fps = 0.0
+        for rate in (video.get('avg_frame_rate'), video.get('r_frame_rate')):
+            if rate and not rate.endswith('/0'):
+                fps = float(Fraction(rate))
+                if fps > 0:
+                    break
+
+        video_duration = float(video.get('duration') or duration)
+        frame_count = int(video['nb_frames']) if video.get('nb_frames') else int(round(video_duration * fps))
+
+        # Rotation lives in the display matrix side data (newer FFmpeg) or the legacy rotate tag
+        rotation = video.get('tags', {}).get('rotate', 0)
+        for side_data in video.get('side_data_list', []):
+            if 'rotation' in side_data:
+                rotation = side_data['rotation']
+
+        info.update({
+            'duration': video_duration,
+            'codec': video.get('codec_name'),
+            'width': video.get('width'),
+            'height': video.get('height'),
+            'fps': fps,
+            'frame_count': frame_count,
+            'rotation': int(float(rotation)) % 360,
+            'profile': video.get('profile'),
+            'level': video.get('level'),
+            'pix_fmt': video.get('pix_fmt'),
+            'bit_rate': int(video['bit_rate']) if video.get('bit_rate') else None,
+        })
+        return info
+
+    def _get_audio_duration(self, audio_path):
+        """Get audio duration from the cached probe"""
+        return self._probe(audio_path)['duration']
+
+    def _file_hash(self, path):
+        """SHA-256 of a file's contents"""
+        digest = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    def _content_hash(self, path):
+        """SHA-256 of a file, remembered in the probe cache until the file changes"""
+        return self._cached_probe(path, 'sha256', self._file_hash)
+
+    def _prepared_audio_path(self, audio_file):
+        """Cache location of the encoded track, keyed on the source bytes and every audio setting"""
+        settings = json.dumps([self.required_duration, self.audio_encoding], sort_keys=True)
+        key = hashlib.sha256(f'{self._content_hash(audio_file)}:{settings}'.encode()).hexdigest()[:16]
+        return self.cache_dir / f'audio_{key}.m4a'
+
+    def _audio_encode_cmd(self, audio_file, output_audio):
+        info = self._probe(audio_file)
+        if (info['audio_codec'] == 'aac' and info['sample_rate'] == self.audio_encoding['sample_rate']
+                and info['channels'] == self.audio_encoding['channels'] and info['duration'] >= self.required_duration
+                and info['audio_bit_rate'] and info['audio_bit_rate'] <= _bitrate_bps(self.audio_encoding['bitrate'])):
+            # Already the App Store format and long enough: trim by copying packets
+            print(f"Audio is already {self.audio_encoding['codec'].upper()} stereo 48 kHz, copying it")
+            return [
+                'ffmpeg', '-y',
+                '-i', str(audio_file),
+                '-map', '0:a:0',
+                '-t', str(self.required_duration),
+                '-c:a', 'copy',
+                str(output_audio)
+            ]
+
+        audio_duration = self._get_audio_duration(audio_file)
+        timeline = plan_timeline(audio_duration, self.required_duration)
+        print(f"Audio duration: {audio_duration:.2f}s (playing {timeline['plays']} times)")
+
+        # Decode the source once and repeat the decoded samples in memory with aloop; sizes
+        # are in output-rate samples so the track ends exactly at the required duration
+        sample_rate = self.audio_encoding['sample_rate']
+        required_samples = int(round(self.required_duration * sample_rate))
+        source_samples = min(math.ceil(audio_duration * sample_rate), required_samples)
+        audio_filter = (f'aresample={sample_rate},'
+                        f"aloop=loop={timeline['extra_loops']}:size={source_samples},"
+                        f'atrim=end_sample={required_samples},asetpts=N/SR/TB')
+        return [
+            'ffmpeg', '-y',
+            '-t', str(self.required_duration),  # Never read past what the preview uses
+            '-i', str(audio_file),
+            '-af', audio_filter,
+            '-vn',
+            '-c:a', self.audio_encoding['codec'],  # AAC audio codec
+            '-b:a', self.audio_encoding['bitrate'],  # 256kbps audio
+            '-ac', str(self.audio_encoding['channels']),  # 2 channel stereo
+            '-ar', str(self.audio_encoding['sample_rate']),  # 48 kHz sample rate
+            str(output_audio)
+        ]
+
+    def _prepare_audio(self, audio_file):
+        """Loop and encode the background audio to the required duration once, cached by content hash"""
+        audio_file = str(audio_file)
+        # The cache directory can be cleaned while a long-lived builder remembers the track
+        if audio_file in self._prepared_audio and self._prepared_audio[audio_file].exists():
+            return self._prepared_audio[audio_file]
+
+        prepared_audio = self._prepared_audio_path(audio_file)
+        if prepared_audio.exists():
+            print(f"Reusing prepared audio: {prepared_audio}")
+        else:
+            self.cache_dir.mkdir(exist_ok=True)
+            # Encode to a temporary name so concurrent runs never see a partial track
+            temp_audio = self._temp_path(prepared_audio)
+            self._run_ffmpeg(self._audio_encode_cmd(audio_file, temp_audio), self.required_duration, label='audio')
+            os.replace(temp_audio, prepared_audio)
+            print(f"Prepared audio track: {prepared_audio}")
+
+        self._prepared_audio[audio_file] = prepared_audio
+        return prepared_audio
+
+    def _build_settings(self, device_type):
+        """Every parameter that affects a device's preview and screenshots"""
+        if device_type.lower() == 'iphone':
+            video_resolution, screenshot_resolution = self.iphone_video_resolution, self.iphone_screenshot_resolution
+        else:
+            video_resolution, screenshot_resolution = self.ipad_video_resolution, self.ipad_screenshot_resolution
+        return {
+            'video_resolution': list(video_resolution),
+            'screenshot_resolution': list(screenshot_resolution),
+            'video_encoding': self.video_encoding,
+            'audio_encoding': self.audio_encoding,
+            'required_duration': self.required_duration,
+            'screenshot_count': self.screenshot_count,
+            'single_pass': self.single_pass,
+            'chunks': self.chunks,
+            'dedupe_frames': self.dedupe_frames,
+        }
+
+    def _build_key(self, input_video, audio_file, device_type):
+        """Content address of a device build: input hashes plus the effective settings"""
+        inputs = {'video': self._content_hash(input_video), 'audio': self._content_hash(audio_file)}
+        payload = json.dumps({'inputs': inputs, 'settings': self._build_settings(device_type)}, sort_keys=True)
+        return hashlib.sha256(payload.encode()).hexdigest(), inputs
+
+    def _load_manifest(self, output_dir):
+        try:
+            with open(output_dir / 'manifest.json') as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return {}
+        if data.get('version') != MANIFEST_VERSION:
+            return {}
+        return data.get('devices', {})
+
+    def _outputs_match(self, entry, output_dir):
+        """Whether every artifact recorded for a build is still present and unmodified in size"""
+        for relative_path, size in entry.get('outputs', {}).items():
+            path = output_dir / relative_path
+            if not path.is_file() or path.stat().st_size != size:
+                return False
+        return bool(entry.get('outputs'))
+
+    def _record_build(self, output_dir, device_type, entry):
+        with self._locked('manifest'):
+            devices = self._load_manifest(output_dir)
+            devices[device_type] = entry
+            self._write_json(output_dir / 'manifest.json', {'version': MANIFEST_VERSION, 'devices': devices})
+
+    def _load_journal(self, output_dir):
+        try:
+            with open(output_dir / 'journal.json') as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return {}
+        if data.get('version') != JOURNAL_VERSION:
+            return {}
+        return data.get('devices', {})
+
+    def _resume_step(self, plan, step):
+        """Whether an interrupted attempt at this exact build already finished `step`"""
+        if not self.use_build_cache:
+            return False
+        entry = self._load_journal(plan['output_dir']).get(plan['device_type'])
+        if not entry or entry.get('key') != plan['build_key'] or step not in entry.get('steps', {}):
+            return False
+        if not self._outputs_match({'outputs': entry['steps'][step]}, plan['output_dir']):
+            return False
+        print(f"Resuming {plan['device_type']}: {step} already finished")
+        return True
+
+    def _journal_step(self, plan, step, artifacts):
+        """Note a finished step and its artifacts so a rerun after a failure can skip it"""
+        output_dir = plan['output_dir']
+        with self._locked('journal'):
+            devices = self._load_journal(output_dir)
+            entry = devices.get(plan['device_type'])
+            if not entry or entry.get('key') != plan['build_key']:
+                entry = {'key': plan['build_key'], 'steps': {}}
+            entry['steps'][step] = {str(path.relative_to(output_dir)): path.stat().st_size
+                                    for path in artifacts if path.exists()}
+            devices[plan['device_type']] = entry
+            self._write_json(output_dir / 'journal.json', {'version': JOURNAL_VERSION, 'devices': devices})
+
+    def _close_journal(self, plan):
+        """Drop a completed build from the journal; the manifest records it from now on"""
+        output_dir = plan['output_dir']
+        with self._locked('journal'):
+            devices = self._load_journal(output_dir)
+            if devices.pop(plan['device_type'], None) is None:
+                return
+            if devices:
+                self._write_json(output_dir / 'journal.json', {'version': JOURNAL_VERSION, 'devices': devices})
+            else:
+                (output_dir / 'journal.json').unlink()
+
+    def _parse_progress(self, fields, label, duration):
+        """Turn one block of FFmpeg -progress key=value fields into a progress snapshot"""
+        def number(key):
+            try:
+                return float(fields[key].rstrip('x'))
+            except (KeyError, ValueError):
+                return None
+
+        # out_time_ms is really microseconds in FFmpeg; prefer the explicit out_time_us
+        out_time_us = number('out_time_us')
+        if out_time_us is None:
+            out_time_us = number('out_time_ms')
+        out_time = out_time_us / 1e6 if out_time_us is not None else None
+        done = fields.get('progress') == 'end'
+
+        percent = None
+        if duration and out_time is not None:
+            percent = 100.0 if done else min(100.0, max(0.0, out_time / duration * 100))
+        return {
+            'label': label,
+            'frame': int(number('frame') or 0),
+            'fps': number('fps'),
+            'out_time': out_time,
+            'speed': number('speed'),
+            'percent': percent,
+            'done': done,
+        }
+
+    def iter_ffmpeg_progress(self, ffmpeg_cmd, duration=None, label='ffmpeg'):
+        """Run an FFmpeg command, yielding a progress snapshot each time FFmpeg reports one
+
+        Raises subprocess.CalledProcessError when FFmpeg fails and EncodeStalledError when
+        the watchdog (min_speed/stall_timeout) had to kill it.
+        """
+        cmd = [ffmpeg_cmd[0], '-progress', 'pipe:1', '-nostats'] + list(ffmpeg_cmd[1:])
+        process = subprocess.Popen(cmd, stdout=subprocess.PIPE, text=True)
+        watchdog = None
+        if self.min_speed or self.stall_timeout:
+            watchdog = _StallWatchdog(process, self.min_speed, self.stall_timeout or 30)
+        try:
+            fields = {}
+            for line in process.stdout:
+                key, _, value = line.strip().partition('=')
+                fields[key] = value
+                # Each report block ends with progress=continue or progress=end
+                if key == 'progress':
+                    progress = self._parse_progress(fields, label, duration)
+                    if watchdog:
+                        watchdog.update(progress)
+                    yield progress
+                    fields = {}
+            returncode = process.wait()
+        finally:
+            if watchdog:
+                watchdog.stop()
+            if process.poll() is None:
+                process.kill()
+                process.wait()
+            process.stdout.close()
+
+        if watchdog and watchdog.stalled:
+            raise EncodeStalledError(f'{label}: FFmpeg killed, {watchdog.stalled}')
+        if returncode:
+            raise subprocess.CalledProcessError(returncode, cmd)
+
+    def _run_ffmpeg(self, ffmpeg_cmd, duration=None, label='ffmpeg'):
+        """Run an FFmpeg command to completion, forwarding progress to the callback"""
+        for progress in self.iter_ffmpeg_progress(ffmpeg_cmd, duration, label):
+            if self.progress_callback:
+                self.progress_callback(progress)
+
+    def _preview_filter(self, info, width, height, plays=1):
+        """Filter chain producing the preview frames from the probed input
+
+        Trimming and frame rate conversion come first, so frames that the 30 fps preview
+        drops (most of a 60-120 fps ProMotion recording) are never scaled or padded. With
+        plays > 1 the input is decoded once and the finished frames are repeated in memory.
+        """
+        fps = self.video_encoding['fps']
+        filters = [] if plays > 1 else [f'trim=duration={self.required_duration}']
+        # Looping counts frames, so it needs constant frame rate even from a 30 fps VFR source
+        if plays > 1 or not info.get('fps') or abs(info['fps'] - fps) > 0.01:
+            filters.append(f'fps={fps}')
+        if self.dedupe_frames:
+            # Static stretches of a screen recording repeat the same frame: drop repeats before
+            # scaling, then hold each scaled frame until the next change to get back to constant
+            # 30 fps. Frames dropped at the end are restored by cloning the last one; the output
+            # duration limit (or the loop's frame count) cuts the excess.
+            filters += ['mpdecimate'] + self._scale_filters(info, width, height) + [
+                f'fps={fps}', f'tpad=stop_mode=clone:stop_duration={self.required_duration}']
+        else:
+            filters += self._scale_filters(info, width, height)
+        if plays > 1:
+            frames = self._clip_frames(info)
+            filters += [f'trim=end_frame={frames}', f'loop=loop={plays - 1}:size={frames}', f'setpts=N/{fps}/TB']
+        return ','.join(filters)
+
+    def _clip_frames(self, info):
+        """Frames in one play of the source at the preview frame rate"""
+        return max(1, int(round(info['duration'] * self.video_encoding['fps'])))
+
+    def _loop_in_memory(self, info, plays, width, height):
+        """Whether one play of the scaled source fits the memory budget of the loop filter"""
+        if plays <= 1 or self.chunks > 1 or not self.loop_memory_budget:
+            return False
+        # 4:2:0 frames take 1.5 bytes per pixel; assume packed RGBA-sized frames otherwise
+        bytes_per_pixel = 1.5 if (info.get('pix_fmt') or 'yuv420p') in ('yuv420p', 'yuvj420p', 'nv12') else 4
+        return self._clip_frames(info) * width * height * bytes_per_pixel <= self.loop_memory_budget
+
+    def _scale_filters(self, info, width, height):
+        """Filters fitting the probed input into the preview frame, doing as little work as possible"""
+        src_width, src_height = info.get('width'), info.get('height')
+        if not src_width or not src_height:
+            # Unknown geometry: fit and pad, which is correct for any input
+            return [f'scale={width}:{height}:force_original_aspect_ratio=decrease:force_divisible_by=2',
+                    f'pad={width}:{height}:(ow-iw)/2:(oh-ih)/2']
+        if info.get('rotation') in (90, 270):
+            src_width, src_height = src_height, src_width  # FFmpeg autorotates before the filter graph
+        if (src_width, src_height) == (width, height):
+            return []
+
+        # Area averaging is cheapest and alias-free for big reductions, bicubic suits mild
+        # ones and Lanczos keeps edges sharp when enlarging
+        factor = max(src_width / width, src_height / height)
+        flags = 'area' if factor >= 2 else 'bicubic' if factor > 1 else 'lanczos'
+
+        # Within 1% of the target aspect the stretch is invisible, so skip the pad
+        if abs(src_width * height - src_height * width) <= 0.01 * src_height * width:
+            return [f'scale={width}:{height}:flags={flags}']
+        return [f'scale={width}:{height}:force_original_aspect_ratio=decrease:force_divisible_by=2:flags={flags}',
+                f'pad={width}:{height}:(ow-iw)/2:(oh-ih)/2']
+
+    def _stream_copy_max_bitrate(self):
+        """Highest source bit rate that is copied: the App Store limit, or an explicit lower --bitrate"""
+        if self.bitrate:
+            return min(STREAM_COPY_MAX_BITRATE, _bitrate_bps(self.bitrate))
+        return STREAM_COPY_MAX_BITRATE
+
+    def _stream_copy_blockers(self, info, width, height):
+        """Why the probed video can't go into the preview unchanged; empty when it can be stream-copied"""
+        encoding = self.video_encoding
+        blockers = []
+        if info.get('codec') != 'h264':
+            blockers.append(f"codec is {info.get('codec')}, not h264")
+        if (info.get('profile') or '').lower() != encoding['profile']:
+            blockers.append(f"profile is {info.get('profile')}, not {encoding['profile']}")
+        # FFprobe reports level 4.0 as 40; lower levels stay within 4.0's limits
+        if not info.get('level') or not 0 < info['level'] <= float(encoding['level']) * 10:
+            blockers.append(f"level is {info.get('level')}, above {encoding['level']}")
+        if (info.get('width'), info.get('height')) != (width, height) or info.get('rotation'):
+            blockers.append(f"frame is {info.get('width')}x{info.get('height')} rotated {info.get('rotation')}, "
+                            f"not {width}x{height}")
+        if abs((info.get('fps') or 0) - encoding['fps']) > 0.01:
+            blockers.append(f"frame rate is {info.get('fps')}, not {encoding['fps']}")
+        if info.get('pix_fmt') != 'yuv420p':
+            blockers.append(f"pixel format is {info.get('pix_fmt')}, not yuv420p")
+        max_bitrate = self._stream_copy_max_bitrate()
+        if not info.get('bit_rate') or info['bit_rate'] > max_bitrate:
+            blockers.append(f"bit rate {info.get('bit_rate')} is unknown or above {max_bitrate}")
+        if info.get('duration', 0) < self.required_duration:
+            blockers.append(f"shorter than {self.required_duration}s, needs looping")
+        return blockers
+
+    def _stream_copy_command(self, plan):
+        """Remux the first required_duration seconds of a compliant source without re-encoding"""
+        # The cut starts at the first frame, which is a keyframe, so it is GOP-aligned and only
+        # the end needs trimming
+        frames = int(round(self.required_duration * self.video_encoding['fps']))
+        return [
+            'ffmpeg', '-y',
+            '-i', str(plan['input_video']),
+            '-i', str(plan['prepared_audio']),
+            '-map', '0:v:0',
+            '-map', '1:a:0',
+            '-frames:v', str(frames),
+            '-t', str(self.required_duration),
+            '-c', 'copy',  # Source video is compliant and the prepared audio is already AAC
+            str(plan['temp_video'])
+        ]
+
+    def _video_encode_args(self, threads=None, passlog=None, pass_number=None):
+        """FFmpeg output options for the App Store H.264 video stream"""
+        encoding = self.video_encoding
+        args = [
+            '-r', str(encoding['fps']),  # Set output frame rate to 30 fps
+            '-c:v', encoding['codec'],  # H.264 codec
+            '-profile:v', encoding['profile'],  # High Profile
+            '-level:v', encoding['level'],  # Level 4.0
+        ]
+        if 'crf' in encoding:
+            args += ['-crf', str(encoding['crf'])]  # Constant quality, no bitrate target
+        else:
+            args += ['-b:v', encoding['bitrate']]
+        for option in ('maxrate', 'bufsize'):
+            if option in encoding:
+                args += [f'-{option}', encoding[option]]
+        args += ['-preset', encoding['preset']]
+        if threads:
+            args += ['-threads', str(threads)]
+        if passlog:
+            args += ['-pass', str(pass_number), '-passlogfile', str(passlog)]
+        return args
+
+    def _first_pass(self, plan, input_args, limit_args, threads=None):
+        """Analysis pass of a two-pass encode and its stats prefix, or None for single-pass profiles
+
+        The stats only depend on the frames the encoder sees and its analysis settings, so they
+        are cached by source hash, trim and filter chain; re-encoding at another bitrate reuses
+        them and only runs the second pass.
+        """
+        if self.video_encoding.get('passes', 1) != 2:
+            return None
+        encoding = self.video_encoding
+        payload = json.dumps({
+            'video': plan['input_hashes']['video'],
+            'input_args': [arg for arg in input_args if arg != str(plan['input_video'])],
+            'filter': plan['preview_filter'],
+            'limit_args': limit_args,
+            'encoder': [encoding[name] for name in ('codec', 'profile', 'level', 'fps', 'preset')],
+        })
+        passlog = self.cache_dir / f'passlog_{hashlib.sha256(payload.encode()).hexdigest()[:16]}'
+        cmd = (['ffmpeg', '-y'] + input_args +
+               ['-map', '0:v:0', '-vf', plan['preview_filter']] + limit_args + ['-an'] +
+               self._video_encode_args(threads, passlog, 1) + ['-f', 'null', os.devnull])
+        return {'cmd': cmd, 'passlog': passlog}
+
+    def _passlog_ready(self, passlog):
+        # x264 writes its files under .temp names and renames them when the pass completes.
+        # The macroblock-tree stats only exist when the preset keeps mbtree on
+        suffixes = ['']
+        if self.video_encoding['preset'] not in ('ultrafast', 'superfast'):
+            suffixes.append('.mbtree')
+        return all(Path(f'{passlog}-0.log{suffix}').exists() for suffix in suffixes)
+
+    def _run_encode(self, first_pass, ffmpeg_cmd, duration, label):
+        """Run an encode, preceded by its analysis pass when the profile is two-pass"""
+        if first_pass:
+            with self._locked(first_pass['passlog'].name):
+                if self._passlog_ready(first_pass['passlog']):
+                    print(f"Reusing first-pass stats: {first_pass['passlog']}")
+                else:
+                    self._run_ffmpeg(first_pass['cmd'], duration, label=f'{label} pass 1')
+        self._run_ffmpeg(ffmpeg_cmd, duration, label=label)
+
+    def _segment_concurrency(self, segment_count):
+        """How many segments encode at once, and the threads each gets, within the thread budget
+
+        Without --threads the budget is the CPU count, so N segments never each start an
+        auto-threaded x264 sized for the whole machine.
+        """
+        budget = self.threads or os.cpu_count() or 1
+        workers = max(1, min(segment_count, budget))
+        return workers, max(1, budget // workers)
+
+    def _segment_commands(self, plan, chunk_dir):
+        """FFmpeg commands encoding the preview timeline as frame-aligned standalone segments"""
+        fps = self.video_encoding['fps']
+        total_frames = int(round(self.required_duration * fps))
+        segment_frames = -(-total_frames // self.chunks)
+        boundaries = list(range(0, total_frames, segment_frames)) + [total_frames]
+        segment_count = len(boundaries) - 1
+        segment_workers, segment_threads = self._segment_concurrency(segment_count)
+        print(f"Encoding preview as {segment_count} segments of {segment_frames} frames, "
+              f"{segment_workers} at a time with {segment_threads} threads each")
+
+        segments = []
+        for index in range(segment_count):
+            start_frame, end_frame = boundaries[index], boundaries[index + 1]
+            # Start inside the source clip at the segment's position in the loop; -stream_loop
+            # restarts from the beginning of the file, so the timeline continues seamlessly
+            offset = (start_frame / fps) % plan['video_duration']
+            segment_duration = (end_frame - start_frame) / fps
+            timeline = plan_timeline(plan['video_duration'], segment_duration, offset)
+            segment_path = chunk_dir / f'segment_{index:03d}.mp4'
+            input_args = [
+                '-ss', f'{offset:.6f}',
+                '-stream_loop', str(timeline['extra_loops']),
+                '-t', f'{segment_duration:.6f}',  # Stop demuxing once the segment is covered
+                '-i', str(plan['input_video']),
+            ]
+            limit_args = ['-frames:v', str(end_frame - start_frame)]  # Exact frame count keeps segments GOP-aligned
+            first_pass = self._first_pass(plan, input_args, limit_args, segment_threads)
+            ffmpeg_cmd = ['ffmpeg', '-y'] + input_args + ['-map', '0:v:0', '-vf', plan['preview_filter']]
+            ffmpeg_cmd += limit_args + ['-an']
+            ffmpeg_cmd += self._video_encode_args(segment_threads, first_pass and first_pass['passlog'], 2)
+            ffmpeg_cmd.append(str(segment_path))
+            segments.append({
+                'first_pass': first_pass,
+                'cmd': ffmpeg_cmd,
+                'duration': segment_duration,
+                'label': f"{plan['device_type']} {segment_path.stem}",
+                'path': segment_path,
+            })
+        return segments
+
+    def _concat_command(self, plan, segment_paths, chunk_dir):
+        """FFmpeg command joining encoded segments and the prepared audio without re-encoding"""
+        concat_list = chunk_dir / 'segments.txt'
+        concat_list.write_text(''.join(
+            "file '{}'\n".format(str(path.resolve()).replace("'", "'\\''")) for path in segment_paths))
+        return [
+            'ffmpeg', '-y',
+            '-f', 'concat',
+            '-safe', '0',
+            '-i', str(concat_list),
+            '-i', str(plan['prepared_audio']),
+            '-map', '0:v:0',
+            '-map', '1:a:0',
+            '-t', str(self.required_duration),
+            '-c', 'copy',  # Segments and prepared audio are already encoded
+            str(plan['temp_video'])
+        ]
+
+    def _encode_chunked(self, plan):
+        """Encode the preview as frame-aligned segments in parallel, then join them without re-encoding"""
+        # Every segment starts with an IDR frame and uses identical encoder settings (same
+        # profile, level and VBR constraints), so the concat demuxer can join them losslessly
+        self.cache_dir.mkdir(exist_ok=True)
+        with tempfile.TemporaryDirectory(dir=self.cache_dir, prefix='chunks_') as chunk_dir:
+            segments = self._segment_commands(plan, Path(chunk_dir))
+            with ThreadPoolExecutor(max_workers=self._segment_concurrency(len(segments))[0]) as executor:
+                futures = [executor.submit(self._run_encode, segment['first_pass'], segment['cmd'],
+                                           segment['duration'], segment['label'])
+                           for segment in segments]
+                for future in futures:
+                    future.result()
+
+            concat_cmd = self._concat_command(plan, [segment['path'] for segment in segments], Path(chunk_dir))
+            self._run_ffmpeg(concat_cmd, self.required_duration, label=f"{plan['device_type']} concat")
+
+    def _output_paths(self, output_dir, device_type):
+        screenshots_dir = output_dir / f'{device_type}_screenshots'
+        return {
+            'output_video': output_dir / f'{device_type}_preview.mp4',
+            'screenshots_dir': screenshots_dir,
+            'screenshots': [screenshots_dir / f'{device_type}_screenshot_{index}.jpg'
+                            for index in range(1, self.screenshot_count + 1)],
+        }
+
+    def _plan_build(self, input_video, audio_file, device_type, output_dir):
+        """Work out paths and the FFmpeg command for a device build; None when it is up to date"""
+        # Batch jobs write to their own directories while sharing this builder's caches
+        output_dir = Path(output_dir) if output_dir else self.output_dir
+        output_dir.mkdir(parents=True, exist_ok=True)
+
+        with self.report.stage('build_key', device=device_type):
+            build_key, input_hashes = self._build_key(input_video, audio_file, device_type)
+        if self.use_build_cache:
+            entry = self._load_manifest(output_dir).get(device_type)
+            if entry and entry.get('key') == build_key and self._outputs_match(entry, output_dir):
+                print(f"Skipping {device_type}: outputs are up to date (build {build_key[:12]})")
+                return None
+
         # Create screenshots directory if it doesn't exist
-        screenshots_dir = self.output_dir / f'{device_type}_screenshots'
+        paths = self._output_paths(output_dir, device_type)
+        screenshots_dir = paths['screenshots_dir']
         screenshots_dir.mkdir(exist_ok=True)
 
+        # Artifacts are renamed into place only once complete; drop leftovers of a killed attempt
+        # but not the temp files of builds still running in this or another process
+        self._remove_stale_temps(list(output_dir.glob(f'{device_type}_preview.*.tmp.mp4')) +
+                                 list(screenshots_dir.glob('*.tmp.jpg')))
+
         # Set resolution based on device type for video preview
         if device_type.lower() == 'iphone':
             width, height = self.iphone_video_resolution
@@ -47,60 +1043,415 @@ class PreviewBuilder:
             width, height = self.ipad_video_resolution
 
         # Generate output video filename
-        output_video = self.output_dir / f'{device_type}_preview.mp4'
+        output_video = paths['output_video']
 
-        # Calculate number of loops needed to reach 1 minute for both video and audio
-        video_duration = self._get_video_duration(input_video)
-        audio_duration = self._get_audio_duration(audio_file)
-        
-        video_loops = max(1, int(np.ceil(self.required_duration / video_duration)))
-        audio_loops = max(1, int(np.ceil(self.required_duration / audio_duration)))
+        # Calculate number of loops needed to reach the required duration
+        with self.report.stage('probe', device=device_type):
+            video_duration = self._get_video_duration(input_video)
+            info = self._probe(input_video)
+            copy_blockers = self._stream_copy_blockers(info, width, height)
+        timeline = plan_timeline(video_duration, self.required_duration)
+        loop_in_memory = self._loop_in_memory(info, timeline['plays'], width, height)
+        preview_filter = self._preview_filter(info, width, height, timeline['plays'] if loop_in_memory else 1)
+        if copy_blockers:
+            print(f"Preview filter: {preview_filter}")
+        else:
+            print(f"Input is already App Store compliant ({info['bit_rate'] / 1e6:.1f} Mbps, at most "
+                  f"{self._stream_copy_max_bitrate() / 1e6:.1f} Mbps allowed), stream-copying the {device_type} preview")
+        print(f"Video duration: {video_duration:.2f}s (playing {timeline['plays']} times"
+              f"{', decoded once and looped in memory' if loop_in_memory else ''})")
 
-        print(f"Video duration: {video_duration:.2f}s (looping {video_loops} times)")
-        print(f"Audio duration: {audio_duration:.2f}s (looping {audio_loops} times)")
+        # The looped AAC track is shared by every device, so it is only muxed here
+        with self.report.stage('prepare_audio', device=device_type):
+            prepared_audio = self._prepare_audio(audio_file)
+
+        # Chunked encodes take screenshots separately, the split graph only fits a single encode
+        single_pass = self.single_pass and self.chunks <= 1
+        temp_tag = f'{os.getpid()}-{uuid.uuid4().hex[:8]}'
+        plan = {
+            'input_video': input_video,
+            'audio_file': audio_file,
+            'device_type': device_type,
+            'output_dir': output_dir,
+            'build_key': build_key,
+            'input_hashes': input_hashes,
+            'screenshots_dir': screenshots_dir,
+            'screenshots': paths['screenshots'],
+            'output_video': output_video,
+            'temp_tag': temp_tag,  # Shared by this attempt's temp video and single-pass screenshots
+            'temp_video': self._temp_path(output_video, temp_tag),
+            'video_duration': video_duration,
+            'prepared_audio': prepared_audio,
+            'preview_filter': preview_filter,
+            'single_pass': single_pass,
+            'ffmpeg_cmd': None,  # Chunked encodes build per-segment commands instead
+            'first_pass': None,
+            'stream_copy': not copy_blockers,
+        }
+        if not copy_blockers:
+            # Nothing is decoded, so screenshots come from the OpenCV capture
+            plan.update(single_pass=False, ffmpeg_cmd=self._stream_copy_command(plan))
+            return plan
+        if self.chunks > 1:
+            return plan
+
+        # Only demux the exact plays the preview needs; single-pass screenshots may sit past
+        # the preview's end, so that mode reads at least the whole source once
+        read_seconds = max(self.required_duration, video_duration) if single_pass else self.required_duration
 
         # Process video with FFmpeg
-        ffmpeg_cmd = [
-            'ffmpeg', '-y',  # Overwrite output file if exists
-            '-stream_loop', str(video_loops),
-            '-i', str(input_video),
-            '-stream_loop', str(audio_loops),
-            '-i', str(audio_file),
-            '-vf', f'scale={width}:{height},pad={width}:{height}:0:0',
+        if loop_in_memory:
+            input_args = ['-i', str(input_video)]  # One play; the loop filter repeats it
+        else:
+            input_args = [
+                '-stream_loop', str(timeline['extra_loops']),
+                '-t', f'{read_seconds:.6f}',
+                '-i', str(input_video),
+            ]
+        ffmpeg_cmd = ['ffmpeg', '-y'] + input_args + ['-i', str(prepared_audio)]  # Overwrite output file if exists
+
+        if single_pass:
+            # Decode the input once: split frames between the preview encode and a select
+            # branch that writes the screenshots at full quality
+            if device_type.lower() == 'iphone':
+                shot_width, shot_height = self.iphone_screenshot_resolution
+            else:
+                shot_width, shot_height = self.ipad_screenshot_resolution
+            frame_positions = sorted(set(self._screenshot_positions(input_video)))
+            plan['frame_positions'] = frame_positions
+            select = '+'.join(f'eq(n,{pos})' for pos in frame_positions)
+            ffmpeg_cmd += [
+                '-filter_complex',
+                f'[0:v]split=2[preview_in][shots_in];'
+                f"[preview_in]{plan['preview_filter']}[preview];"
+                # Renumber the selected frames one second apart so the 1 fps image output
+                # writes each exactly once without -fps_mode, which FFmpeg 4.x lacks
+                f"[shots_in]select='{select}',setpts=N/TB,scale={shot_width}:{shot_height}:flags=lanczos[shots]",
+                '-map', '[preview]',
+            ]
+        else:
+            ffmpeg_cmd += ['-map', '0:v:0', '-vf', plan['preview_filter']]
+
+        first_pass = self._first_pass(plan, input_args, ['-t', str(self.required_duration)], self.threads)
+        plan['first_pass'] = first_pass
+
+        ffmpeg_cmd += ['-map', '1:a:0', '-t', str(self.required_duration)]
+        ffmpeg_cmd += self._video_encode_args(self.threads, first_pass and first_pass['passlog'], 2)
+        ffmpeg_cmd += ['-c:a', 'copy']  # Prepared track is already AAC 256kbps stereo 48 kHz
+        ffmpeg_cmd.append(str(plan['temp_video']))
+
+        if single_pass:
+            # Selected frames are numbered from 1 to match the OpenCV capture naming
+            ffmpeg_cmd += [
+                '-map', '[shots]',
+                '-frames:v', str(len(frame_positions)),
+                '-r', '1',  # Matches the renumbered timestamps, so no frame is duplicated or dropped
+                '-q:v', '2',  # High JPEG quality
+                str(self._temp_path(screenshots_dir / f'{device_type}_screenshot_%d.jpg', temp_tag))
+            ]
+        plan['ffmpeg_cmd'] = ffmpeg_cmd
+        return plan
+
+    def _commit_encode(self, plan):
+        """Move the finished encode's artifacts into place and journal the step"""
+        os.replace(plan['temp_video'], plan['output_video'])
+        if plan['single_pass']:
+            for screenshot in plan['screenshots']:
+                temp_screenshot = self._temp_path(screenshot, plan['temp_tag'])
+                if temp_screenshot.exists():
+                    os.replace(temp_screenshot, screenshot)
+        self._journal_step(plan, 'encode', self._encode_outputs(plan))
+
+    def _take_screenshots(self, plan):
+        if plan['single_pass']:
+            captured = len(plan['frame_positions'])
+            print(f"Captured {captured} screenshots in the same pass: {plan['screenshots_dir']}")
+            if captured != self.screenshot_count:
+                print(f"Warning: Only captured {captured} screenshots instead of {self.screenshot_count}")
+        else:
+            # Capture screenshots from original input video
+            self._capture_screenshots(str(plan['input_video']), plan['screenshots_dir'], plan['device_type'])
+            self._journal_step(plan, 'screenshots', plan['screenshots'])
+
+    def _finish_build(self, plan, encode_seconds, screenshots_seconds, total_seconds):
+        """Record what was built from which inputs so unchanged reruns can skip this device"""
+        output_dir = plan['output_dir']
+        outputs = [plan['output_video']] + [path for path in plan['screenshots'] if path.exists()]
+        self._record_build(output_dir, plan['device_type'], {
+            'key': plan['build_key'],
+            'inputs': {'video': str(plan['input_video']), 'audio': str(plan['audio_file'])},
+            'input_sha256': plan['input_hashes'],
+            'settings': self._build_settings(plan['device_type']),
+            'outputs': {str(path.relative_to(output_dir)): path.stat().st_size for path in outputs},
+            'timings': {
+                'encode_seconds': round(encode_seconds, 3),
+                'screenshots_seconds': round(screenshots_seconds, 3),
+                'total_seconds': round(total_seconds, 3),
+            },
+            'built_at': datetime.now(timezone.utc).isoformat(),
+        })
+        self._close_journal(plan)
+
+    def _encode_outputs(self, plan):
+        return [plan['output_video']] + (plan['screenshots'] if plan['single_pass'] else [])
+
+    def process_video(self, input_video, audio_file, device_type='iphone', output_dir=None):
+        print(f"\nProcessing {device_type} video...")
+        started = time.perf_counter()
+
+        plan = self._plan_build(input_video, audio_file, device_type, output_dir)
+        if plan is not None:
+            self._run_plan(plan, started)
+
+    def _run_plan(self, plan, started):
+        device_type = plan['device_type']
+        with self.report.stage('encode', outputs=self._encode_outputs(plan), device=device_type,
+                               chunks=self.chunks, stream_copy=plan['stream_copy']) as encode:
+            if not self._resume_step(plan, 'encode'):
+                if plan['ffmpeg_cmd'] is None:
+                    self._encode_chunked(plan)
+                else:
+                    self._run_encode(plan['first_pass'], plan['ffmpeg_cmd'], self.required_duration,
+                                     label=f'{device_type} encode')
+                self._commit_encode(plan)
+        print(f"Generated preview video for {device_type}: {plan['output_video']}")
+
+        with self.report.stage('screenshots', device=device_type, single_pass=plan['single_pass']) as capture:
+            if plan['single_pass'] or not self._resume_step(plan, 'screenshots'):
+                self._take_screenshots(plan)
+
+        self._finish_build(plan, encode['wall_seconds'], capture['wall_seconds'], time.perf_counter() - started)
+
+    def _reuse_video(self, plan, source):
+        """Finish a build from another build of the same video: mux this audio, copy the screenshots"""
+        started = time.perf_counter()
+        device_type = plan['device_type']
+        with self.report.stage('mux', outputs=[plan['output_video']], device=device_type) as mux:
+            self._run_ffmpeg(self._mux_command(plan, source), self.required_duration, label=f'{device_type} mux')
+            os.replace(plan['temp_video'], plan['output_video'])
+        print(f"Generated preview video for {device_type}: {plan['output_video']}")
+
+        with self.report.stage('screenshots', outputs=plan['screenshots'], device=device_type, copied=True) as capture:
+            self._copy_screenshots(plan, source)
+        self._finish_build(plan, mux['wall_seconds'], capture['wall_seconds'], time.perf_counter() - started)
+
+    def _mux_command(self, plan, source):
+        """Put this build's audio track next to the video stream of `source`"""
+        return [
+            'ffmpeg', '-y',
+            '-i', str(source['output_video']),
+            '-i', str(plan['prepared_audio']),
+            '-map', '0:v:0',
+            '-map', '1:a:0',
             '-t', str(self.required_duration),
-            '-r', '30',  # Set output frame rate to 30 fps
-            '-c:v', 'libx264',  # H.264 codec
-            '-profile:v', 'high',  # High Profile
-            '-level:v', '4.0',  # Level 4.0
-            '-b:v', '11M',  # Target bit rate 10-12 Mbps
-            '-maxrate', '220M',  # VBR max rate ~220 Mbps
-            '-bufsize', '440M',  # VBR buffer size
-            '-preset', 'slow',  # Slower preset for better quality
-            '-c:a', 'aac',  # AAC audio codec
-            '-b:a', '256k',  # 256kbps audio
-            '-ac', '2',  # 2 channel stereo
-            '-ar', '48000',  # 48 kHz sample rate
-            str(output_video)
+            '-c', 'copy',  # The video is already encoded and the prepared audio is already AAC
+            str(plan['temp_video'])
         ]
 
-        subprocess.run(ffmpeg_cmd, check=True)
-        print(f"Generated preview video for {device_type}: {output_video}")
+    def _copy_screenshots(self, plan, source):
+        for source_screenshot, screenshot in zip(source['screenshots'], plan['screenshots']):
+            if source_screenshot.exists():
+                temp_screenshot = self._temp_path(screenshot)
+                shutil.copyfile(source_screenshot, temp_screenshot)
+                os.replace(temp_screenshot, screenshot)
+
+    def _shared_video_groups(self, jobs):
+        """Group (input_video, audio_file, device_type, output_dir) jobs that only differ in audio"""
+        groups = {}
+        for input_video, audio_file, device_type, output_dir in jobs:
+            groups.setdefault((str(input_video), device_type), []).append((audio_file, output_dir))
+        return groups
+
+    def _process_shared_video(self, input_video, device_type, targets):
+        """Build one preview per (audio_file, output_dir) target with a single video encode
+
+        The first build that is already up to date, or else the first one built, provides the
+        video stream and screenshots; every other target only muxes its own audio track.
+        """
+        print(f"\nProcessing {device_type} video for {len(targets)} audio tracks...")
+        source = None
+        pending = []
+        for audio_file, output_dir in targets:
+            plan = self._plan_build(input_video, audio_file, device_type, output_dir)
+            if plan is not None:
+                pending.append(plan)
+            elif source is None:
+                source = self._output_paths(Path(output_dir) if output_dir else self.output_dir, device_type)
+
+        if pending and source is None:
+            source = pending.pop(0)
+            self._run_plan(source, time.perf_counter())
+        for plan in pending:
+            self._reuse_video(plan, source)
+
+    def process_locales(self, jobs, audio_files, output_dir=None, workers=None):
+        """Process (input_video, device_type) jobs once per audio file, encoding each video only once
+
+        Each audio file's previews go to <output_dir>/<audio file name without extension>/.
+        """
+        output_root = Path(output_dir) if output_dir else self.output_dir
+        names = [Path(audio_file).stem for audio_file in audio_files]
+        duplicates = sorted({name for name in names if names.count(name) > 1})
+        if duplicates:
+            raise ValueError(f"Audio files need distinct names, found several called {', '.join(duplicates)}")
+
+        for audio_file in audio_files:
+            with self.report.stage('prepare_audio'):
+                self._prepare_audio(audio_file)
+
+        targets = [(audio_file, output_root / name) for audio_file, name in zip(audio_files, names)]
+        with ThreadPoolExecutor(max_workers=max(1, min(workers or len(jobs), len(jobs)))) as executor:
+            futures = [executor.submit(self._process_shared_video, input_video, device_type, targets)
+                       for input_video, device_type in jobs]
+            for future in futures:
+                future.result()
+
+    def process_videos(self, jobs, audio_file, workers=None):
+        """Process (input_video, device_type) jobs concurrently, up to `workers` at a time"""
+        workers = min(workers or len(jobs), len(jobs))
+
+        # Encode the shared audio before fanning out so workers only reuse it
+        with self.report.stage('prepare_audio'):
+            self._prepare_audio(audio_file)
 
-        # Capture screenshots from original input video
-        self._capture_screenshots(str(input_video), screenshots_dir, device_type)
+        if workers <= 1:
+            for input_video, device_type in jobs:
+                self.process_video(input_video, audio_file, device_type)
+            return
+
+        # Device pipelines run on threads so FFmpeg encodes and GIL-releasing OpenCV
+        # screenshot passes overlap, while progress callbacks still fire in this process
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [
+                executor.submit(self.process_video, input_video, audio_file, device_type)
+                for input_video, device_type in jobs
+            ]
+            for future in futures:
+                future.result()
+
+    def process_batch(self, jobs, workers=None):
+        """Process (input_video, audio_file, device_type, output_dir) jobs on a shared thread pool"""
+        # Threads keep the probe memo and prepared audio shared across jobs; the heavy lifting
+        # happens in FFmpeg subprocesses and GIL-releasing OpenCV calls
+        for audio_file in sorted({str(job[1]) for job in jobs}):
+            with self.report.stage('prepare_audio'):
+                self._prepare_audio(audio_file)
+
+        # Jobs that only differ in audio share one video encode
+        with ThreadPoolExecutor(max_workers=max(1, workers or 1)) as executor:
+            futures = []
+            for (input_video, device_type), targets in self._shared_video_groups(jobs).items():
+                if len(targets) == 1:
+                    audio_file, output_dir = targets[0]
+                    futures.append(executor.submit(self.process_video, input_video, audio_file, device_type, output_dir))
+                else:
+                    futures.append(executor.submit(self._process_shared_video, input_video, device_type, targets))
+            for future in futures:
+                future.result()
 
     def _get_video_duration(self, video_path):
-        cap = cv2.VideoCapture(str(video_path))
-        fps = cap.get(cv2.CAP_PROP_FPS)
-        frame_count = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
-        duration = frame_count / fps
-        cap.release()
-        return duration
+        """Get video duration from the cached probe"""
+        return self._probe(video_path)['duration']
+
+    def _plan_seek_cost(self, frame_positions, keyframes):
+        """Frames decoded when seeking to each target's preceding keyframe and grabbing forward"""
+        cost = 0
+        next_frame = 0  # Index of the frame the decoder would produce next
+        for frame_pos in frame_positions:
+            if frame_pos == next_frame - 1:
+                continue  # Repeated position reuses the frame just decoded
+            keyframe = keyframes[bisect.bisect_right(keyframes, frame_pos) - 1]
+            if not keyframe <= next_frame <= frame_pos:
+                cost += SEEK_COST_FRAMES
+                next_frame = keyframe
+            cost += frame_pos - next_frame + 1
+            next_frame = frame_pos + 1
+        return cost
+
+    def _choose_screenshot_strategy(self, video_path, frame_positions):
+        """Pick sequential decoding or keyframe-aware seeking, whichever decodes fewer frames"""
+        if self.screenshot_strategy != 'auto':
+            return self.screenshot_strategy
+
+        # A forward pass decodes everything up to the last target; seeking pays for each
+        # target's distance from its keyframe, which dominates on long-GOP recordings
+        sequential_cost = frame_positions[-1] + 1
+        seek_cost = self._plan_seek_cost(frame_positions, self._probe_keyframes(video_path))
+        return 'sequential' if sequential_cost <= seek_cost else 'seek'
+
+    def _read_frames_sequential(self, cap, frame_positions):
+        """Yield target frames from a single forward pass, only converting the frames we keep"""
+        frame_index = 0
+        for frame_pos in frame_positions:
+            while frame_index < frame_pos:
+                if not cap.grab():
+                    return
+                frame_index += 1
+            if frame_index == frame_pos:
+                if not cap.grab():
+                    return
+                frame_index += 1
+            ret, frame = cap.retrieve()
+            if ret:
+                yield frame
+
+    def _read_frames_seeking(self, cap, frame_positions, keyframes):
+        """Yield target frames by seeking to the preceding keyframe and grabbing forward"""
+        import cv2
+
+        next_frame = 0
+        frame = None
+        for frame_pos in frame_positions:
+            if frame is not None and frame_pos == next_frame - 1:
+                # Repeated position (clip shorter than the screenshot count)
+                yield frame
+                continue
+            keyframe = keyframes[bisect.bisect_right(keyframes, frame_pos) - 1]
+            # Seeks land exactly on keyframes, so only jump when the target is outside
+            # the stretch the decoder can reach by reading forward
+            if not keyframe <= next_frame <= frame_pos:
+                cap.set(cv2.CAP_PROP_POS_FRAMES, keyframe)
+                next_frame = keyframe
+            while next_frame < frame_pos:
+                if not cap.grab():
+                    return
+                next_frame += 1
+            ret, frame = cap.read()
+            next_frame += 1
+            if not ret:
+                return
+            yield frame
+
+    def _screenshot_positions(self, video_path):
+        """Frame indices of the evenly spaced screenshots"""
+        import numpy as np
+
+        total_frames = self._probe(video_path)['frame_count']
+        # Use linspace to get exactly 6 evenly spaced positions
+        return [int(pos) for pos in np.linspace(0, total_frames - 1, self.screenshot_count, dtype=int)]
+
+    def _write_screenshot(self, frame, screenshot_path, width, height, device_type):
+        """Resize a frame to the screenshot resolution and encode it as JPEG"""
+        import cv2
+
+        with self.report.stage('screenshot_resize', device=device_type):
+            frame_resized = cv2.resize(frame, (width, height), interpolation=cv2.INTER_LANCZOS4)
+        with self.report.stage('screenshot_write', outputs=[screenshot_path], device=device_type):
+            # Same extension, so OpenCV still picks the JPEG encoder for the temp file
+            temp_path = str(self._temp_path(screenshot_path))
+            cv2.imwrite(temp_path, frame_resized)
+            os.replace(temp_path, screenshot_path)
+        return screenshot_path
 
     def _capture_screenshots(self, video_path, output_dir, device_type):
-        cap = cv2.VideoCapture(video_path)
-        total_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
-        
+        # OpenCV and NumPy are only imported once pixels are needed, keeping CLI startup and
+        # cache-hit runs fast
+        import cv2
+
+        # Keep OpenCV within the per-job thread budget
+        if self.threads:
+            cv2.setNumThreads(self.threads)
+
         # Get screenshot resolution based on device type
         if device_type.lower() == 'iphone':
             width, height = self.iphone_screenshot_resolution
@@ -108,78 +1459,537 @@ class PreviewBuilder:
             width, height = self.ipad_screenshot_resolution
         
         # Calculate frame positions for exactly 6 screenshots
-        # Use linspace to get exactly 6 evenly spaced positions
-        frame_positions = np.linspace(0, total_frames - 1, self.screenshot_count, dtype=int)
-        
-        screenshot_count = 0
-        for frame_pos in frame_positions:
-            cap.set(cv2.CAP_PROP_POS_FRAMES, frame_pos)
-            ret, frame = cap.read()
-            
-            if ret:
-                # Resize frame to the correct resolution
-                frame_resized = cv2.resize(frame, (width, height), interpolation=cv2.INTER_LANCZOS4)
-                screenshot_path = os.path.join(output_dir, f'{device_type}_screenshot_{screenshot_count + 1}.jpg')
-                cv2.imwrite(screenshot_path, frame_resized)
+        frame_positions = self._screenshot_positions(video_path)
+
+        strategy = self._choose_screenshot_strategy(video_path, frame_positions)
+        print(f"Capturing screenshots using {strategy} decoding")
+
+        cap = cv2.VideoCapture(video_path)
+        if strategy == 'sequential':
+            frames = self._read_frames_sequential(cap, frame_positions)
+        else:
+            frames = self._read_frames_seeking(cap, frame_positions, self._probe_keyframes(video_path))
+        frames = self.report.timed('screenshot_decode', frames, device=device_type, strategy=strategy)
+
+        # Decoding stays on this thread while workers resize and encode (OpenCV releases
+        # the GIL); the semaphore bounds how many decoded frames wait in memory
+        workers = max(1, self.screenshot_workers or self.threads or os.cpu_count() or 1)
+        in_flight = threading.BoundedSemaphore(workers * 2)
+        futures = []
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            try:
+                for frame in frames:
+                    # Names are assigned in decode order, whatever order the workers finish in
+                    screenshot_path = os.path.join(output_dir, f'{device_type}_screenshot_{len(futures) + 1}.jpg')
+                    in_flight.acquire()
+                    future = executor.submit(self._write_screenshot, frame, screenshot_path, width, height,
+                                             device_type)
+                    future.add_done_callback(lambda _: in_flight.release())
+                    futures.append(future)
+            finally:
+                cap.release()
+
+            screenshot_count = 0
+            for future in futures:
+                screenshot_path = future.result()
                 print(f"Captured screenshot {screenshot_count + 1}/6: {screenshot_path}")
                 screenshot_count += 1
         
-        cap.release()
-        
         # Verify we got all screenshots
         if screenshot_count != self.screenshot_count:
             print(f"Warning: Only captured {screenshot_count} screenshots instead of 6")
 
+class AsyncPreviewBuilder(PreviewBuilder):
+    """PreviewBuilder for asyncio services
+
+    FFprobe and FFmpeg run as asyncio subprocesses and OpenCV work runs in the loop's
+    default executor, so one event loop can drive many preview jobs. `max_jobs` bounds
+    concurrent device builds and `max_processes` bounds concurrent FFmpeg/FFprobe
+    processes, which gives callers backpressure when they submit hundreds of jobs.
+    """
+
+    def __init__(self, output_dir, max_jobs=8, max_processes=None, **kwargs):
+        super().__init__(output_dir, **kwargs)
+        self.max_jobs = max_jobs
+        self.max_processes = max_processes or os.cpu_count() or 1
+        # asyncio primitives belong to one event loop; they are rebuilt whenever the builder
+        # is used from a new one (e.g. across asyncio.run() calls)
+        self._loop = None
+        self._job_slots = None
+        self._process_slots = None
+        self._audio_locks = {}
+        self._passlog_locks = {}
+
+    def _bind_loop(self):
+        loop = asyncio.get_running_loop()
+        if loop is not self._loop:
+            self._loop = loop
+            self._job_slots = asyncio.Semaphore(self.max_jobs)
+            self._process_slots = asyncio.Semaphore(self.max_processes)
+            self._audio_locks = {}
+            self._passlog_locks = {}
+
+    def _semaphores(self):
+        self._bind_loop()
+        return self._job_slots, self._process_slots
+
+    async def _run_subprocess(self, cmd):
+        """Run a command without blocking the loop and return its stdout"""
+        _, process_slots = self._semaphores()
+        async with process_slots:
+            process = await asyncio.create_subprocess_exec(
+                *cmd, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+            stdout, stderr = await process.communicate()
+        if process.returncode:
+            raise subprocess.CalledProcessError(process.returncode, cmd, stdout, stderr)
+        return stdout.decode()
+
+    async def probe(self, media_path):
+        """Async counterpart of _probe, sharing its in-process and on-disk cache"""
+        # Cache lookups and writes stat files, take the probe lock and rewrite probe.json,
+        # so they run in the executor rather than stalling every job on the loop
+        loop = asyncio.get_running_loop()
+        key = await loop.run_in_executor(None, self._probe_key, media_path, 'streams')
+        info = await loop.run_in_executor(None, self._remembered_probe, key)
+        if info is None:
+            output = await self._run_subprocess(self._stream_probe_cmd(Path(media_path).resolve()))
+            info = self._parse_probe(json.loads(output))
+            await loop.run_in_executor(None, self._remember_probe, key, info)
+        return info
+
+    async def probe_keyframes(self, video_path):
+        """Async counterpart of _probe_keyframes"""
+        loop = asyncio.get_running_loop()
+        key = await loop.run_in_executor(None, self._probe_key, video_path, 'keyframes')
+        keyframes = await loop.run_in_executor(None, self._remembered_probe, key)
+        if keyframes is None:
+            fps = (await self.probe(video_path))['fps']
+            output = await self._run_subprocess(self._keyframe_probe_cmd(Path(video_path).resolve()))
+            keyframes = self._parse_keyframes(json.loads(output), fps)
+            await loop.run_in_executor(None, self._remember_probe, key, keyframes)
+        return keyframes
+
+    async def aiter_ffmpeg_progress(self, ffmpeg_cmd, duration=None, label='ffmpeg'):
+        """Async counterpart of iter_ffmpeg_progress, with the same stall watchdog rules"""
+        cmd = [ffmpeg_cmd[0], '-progress', 'pipe:1', '-nostats'] + list(ffmpeg_cmd[1:])
+        timeout = self.stall_timeout or (30 if self.min_speed else None)
+        _, process_slots = self._semaphores()
+        async with process_slots:
+            process = await asyncio.create_subprocess_exec(*cmd, stdout=asyncio.subprocess.PIPE)
+            stalled = None
+            slow_since = None
+            last_advance = time.monotonic()
+            last_position = (0, 0.0)
+            try:
+                fields = {}
+                while True:
+                    # The deadline runs from the last advancing report, not the last line read
+                    remaining = max(0.0, timeout - (time.monotonic() - last_advance)) if timeout else None
+                    try:
+                        line = await asyncio.wait_for(process.stdout.readline(), remaining)
+                    except asyncio.TimeoutError:
+                        stalled = f'no progress for {timeout:.0f}s'
+                        break
+                    if not line:
+                        break
+                    key, _, value = line.decode().strip().partition('=')
+                    fields[key] = value
+                    if key != 'progress':
+                        continue
+
+                    progress = self._parse_progress(fields, label, duration)
+                    fields = {}
+                    now = time.monotonic()
+                    position = _progress_position(progress)
+                    if position > last_position:
+                        last_position = position
+                        last_advance = now
+                    elif timeout and now - last_advance > timeout:
+                        stalled = f'no progress for {timeout:.0f}s'
+                        break
+                    if self.min_speed and progress['speed'] is not None and progress['speed'] < self.min_speed:
+                        slow_since = slow_since or now
+                        if now - slow_since > timeout:
+                            stalled = f'speed below {self.min_speed}x for {timeout:.0f}s'
+                            break
+                    else:
+                        slow_since = None
+                    yield progress
+                returncode = await process.wait() if not stalled else None
+            finally:
+                if process.returncode is None:
+                    process.kill()
+                    await process.wait()
+
+        if stalled:
+            raise EncodeStalledError(f'{label}: FFmpeg killed, {stalled}')
+        if returncode:
+            raise subprocess.CalledProcessError(returncode, cmd)
+
+    async def _run_ffmpeg_async(self, ffmpeg_cmd, duration=None, label='ffmpeg'):
+        async for progress in self.aiter_ffmpeg_progress(ffmpeg_cmd, duration, label):
+            if self.progress_callback:
+                self.progress_callback(progress)
+
+    async def prepare_audio(self, audio_file):
+        """Async counterpart of _prepare_audio; concurrent jobs share one encode per track"""
+        audio_file = str(audio_file)
+        if audio_file in self._prepared_audio and self._prepared_audio[audio_file].exists():
+            return self._prepared_audio[audio_file]
+
+        # Lock on the cache file, not the path string, so two names for the same
+        # track (relative vs absolute, symlinks, copies) still share one encode
+        loop = asyncio.get_running_loop()
+        prepared_audio = await loop.run_in_executor(None, self._prepared_audio_path, audio_file)
+        self._bind_loop()
+        lock = self._audio_locks.setdefault(str(prepared_audio), asyncio.Lock())
+        async with lock:
+            await self.probe(audio_file)
+            if prepared_audio.exists():
+                print(f"Reusing prepared audio: {prepared_audio}")
+            else:
+                self.cache_dir.mkdir(exist_ok=True)
+                temp_audio = self._temp_path(prepared_audio)
+                await self._run_ffmpeg_async(self._audio_encode_cmd(audio_file, temp_audio),
+                                             self.required_duration, label='audio')
+                os.replace(temp_audio, prepared_audio)
+                print(f"Prepared audio track: {prepared_audio}")
+
+            self._prepared_audio[audio_file] = prepared_audio
+            return prepared_audio
+
+    async def _run_encode_async(self, first_pass, ffmpeg_cmd, duration, label):
+        if first_pass:
+            passlog = first_pass['passlog']
+            self._bind_loop()
+            async with self._passlog_locks.setdefault(str(passlog), asyncio.Lock()):
+                if self._passlog_ready(passlog):
+                    print(f"Reusing first-pass stats: {passlog}")
+                else:
+                    await self._run_ffmpeg_async(first_pass['cmd'], duration, label=f'{label} pass 1')
+        await self._run_ffmpeg_async(ffmpeg_cmd, duration, label=label)
+
+    async def _encode_chunked_async(self, plan):
+        self.cache_dir.mkdir(exist_ok=True)
+        with tempfile.TemporaryDirectory(dir=self.cache_dir, prefix='chunks_') as chunk_dir:
+            segments = self._segment_commands(plan, Path(chunk_dir))
+            segment_slots = asyncio.Semaphore(self._segment_concurrency(len(segments))[0])
+
+            async def encode(segment):
+                async with segment_slots:
+                    await self._run_encode_async(segment['first_pass'], segment['cmd'],
+                                                 segment['duration'], segment['label'])
+
+            await asyncio.gather(*(encode(segment) for segment in segments))
+            concat_cmd = self._concat_command(plan, [segment['path'] for segment in segments], Path(chunk_dir))
+            await self._run_ffmpeg_async(concat_cmd, self.required_duration, label=f"{plan['device_type']} concat")
+
+    async def process_video(self, input_video, audio_file, device_type='iphone', output_dir=None):
+        job_slots, _ = self._semaphores()
+        async with job_slots:
+            print(f"\nProcessing {device_type} video...")
+            started = time.perf_counter()
+            loop = asyncio.get_running_loop()
+
+            # Warm the probe and audio caches with non-blocking subprocesses, so the shared
+            # planning code below only does cache lookups and file hashing
+            await self.probe(input_video)
+            await self.prepare_audio(audio_file)
+            plan = await loop.run_in_executor(None, self._plan_build, input_video, audio_file, device_type,
+                                              output_dir)
+            if plan is not None:
+                await self._run_plan_async(plan, started)
+
+    async def _run_plan_async(self, plan, started):
+        device_type = plan['device_type']
+        loop = asyncio.get_running_loop()
+        with self.report.stage('encode', outputs=self._encode_outputs(plan), device=device_type,
+                               chunks=self.chunks, stream_copy=plan['stream_copy']) as encode:
+            if not await loop.run_in_executor(None, self._resume_step, plan, 'encode'):
+                if plan['ffmpeg_cmd'] is None:
+                    await self._encode_chunked_async(plan)
+                else:
+                    await self._run_encode_async(plan['first_pass'], plan['ffmpeg_cmd'], self.required_duration,
+                                                 label=f'{device_type} encode')
+                await loop.run_in_executor(None, self._commit_encode, plan)
+        print(f"Generated preview video for {device_type}: {plan['output_video']}")
+
+        with self.report.stage('screenshots', device=device_type, single_pass=plan['single_pass']) as capture:
+            if plan['single_pass'] or not await loop.run_in_executor(None, self._resume_step, plan, 'screenshots'):
+                if not plan['single_pass'] and self.screenshot_strategy != 'sequential':
+                    await self.probe_keyframes(plan['input_video'])
+                await loop.run_in_executor(None, self._take_screenshots, plan)
+
+        await loop.run_in_executor(None, self._finish_build, plan, encode['wall_seconds'],
+                                   capture['wall_seconds'], time.perf_counter() - started)
+
+    async def _reuse_video_async(self, plan, source):
+        started = time.perf_counter()
+        device_type = plan['device_type']
+        loop = asyncio.get_running_loop()
+        with self.report.stage('mux', outputs=[plan['output_video']], device=device_type) as mux:
+            await self._run_ffmpeg_async(self._mux_command(plan, source), self.required_duration,
+                                         label=f'{device_type} mux')
+            os.replace(plan['temp_video'], plan['output_video'])
+        print(f"Generated preview video for {device_type}: {plan['output_video']}")
+
+        with self.report.stage('screenshots', outputs=plan['screenshots'], device=device_type, copied=True) as capture:
+            await loop.run_in_executor(None, self._copy_screenshots, plan, source)
+        await loop.run_in_executor(None, self._finish_build, plan, mux['wall_seconds'],
+                                   capture['wall_seconds'], time.perf_counter() - started)
+
+    async def _process_shared_video_async(self, input_video, device_type, targets):
+        """Async counterpart of _process_shared_video; the group holds one job slot"""
+        job_slots, _ = self._semaphores()
+        async with job_slots:
+            print(f"\nProcessing {device_type} video for {len(targets)} audio tracks...")
+            loop = asyncio.get_running_loop()
+            await self.probe(input_video)
+            source = None
+            pending = []
+            for audio_file, output_dir in targets:
+                await self.prepare_audio(audio_file)
+                plan = await loop.run_in_executor(None, self._plan_build, input_video, audio_file, device_type,
+                                                  output_dir)
+                if plan is not None:
+                    pending.append(plan)
+                elif source is None:
+                    source = self._output_paths(Path(output_dir) if output_dir else self.output_dir, device_type)
+
+            if pending and source is None:
+                source = pending.pop(0)
+                await self._run_plan_async(source, time.perf_counter())
+            for plan in pending:
+                await self._reuse_video_async(plan, source)
+
+    async def process_videos(self, jobs, audio_file, workers=None):
+        """Process (input_video, device_type) jobs concurrently on the event loop, up to `workers` at a time"""
+        await self.process_batch([(input_video, audio_file, device_type, None)
+                                  for input_video, device_type in jobs], workers)
+
+    async def process_batch(self, jobs, workers=None):
+        """Process (input_video, audio_file, device_type, output_dir) jobs, at most max_jobs at a time
+
+        Like PreviewBuilder.process_batch, jobs that only differ in audio share one video encode.
+        `workers` further limits how many of this batch's builds run at once.
+        """
+        limit = asyncio.Semaphore(workers) if workers else None
+
+        async def limited(build):
+            if limit is None:
+                return await build
+            async with limit:
+                return await build
+
+        tasks = []
+        for (input_video, device_type), targets in self._shared_video_groups(jobs).items():
+            if len(targets) == 1:
+                audio_file, output_dir = targets[0]
+                tasks.append(self.process_video(input_video, audio_file, device_type, output_dir))
+            else:
+                tasks.append(self._process_shared_video_async(input_video, device_type, targets))
+        await asyncio.gather(*(limited(task) for task in tasks))
+
+_last_progress_print = {}
+
+def print_progress(progress, interval=5.0):
+    """Progress callback for the CLI: one line per task every few seconds, plus completion"""
+    now = time.monotonic()
+    if not progress['done'] and now - _last_progress_print.get(progress['label'], 0) < interval:
+        return
+    _last_progress_print[progress['label']] = now
+    percent = f"{progress['percent']:5.1f}%" if progress['percent'] is not None else '    ?'
+    fps = f"{progress['fps']:.0f}" if progress['fps'] is not None else '?'
+    speed = f"{progress['speed']:.2f}x" if progress['speed'] is not None else '?'
+    print(f"[{progress['label']}] {percent}  fps={fps}  speed={speed}")
+
+def validate_input_files(video_files, audio_files):
+    """Return an error message for the first missing or unsupported input, or None"""
+    supported_video_extensions = ['.mov', '.m4v', '.mp4']
+    supported_audio_extensions = ['.mp3', '.wav', '.aac', '.m4a']
+
+    for input_file, supported_extensions, kind in (
+            [(path, supported_video_extensions, 'video') for path in sorted(video_files)] +
+            [(path, supported_audio_extensions, 'audio') for path in sorted(audio_files)]):
+        if not os.path.exists(input_file):
+            return f"Input file not found: {input_file}"
+
+        file_ext = os.path.splitext(input_file)[1].lower()
+        if file_ext not in supported_extensions:
+            return f"Unsupported {kind} file extension: {file_ext}. Supported extensions are: {', '.join(supported_extensions)}"
+    return None
+
+def load_batch_manifest(manifest_path, output_root):
+    """Expand a batch manifest into (input_video, audio_file, device_type, output_dir) jobs
+
+    The manifest holds a "jobs" list; each job names an "iphone" and/or "ipad" video, an
+    "audio" file (or inherits one from "defaults") and optionally an "output" directory,
+    which defaults to <output_root>/<name>. Relative paths are resolved against the
+    manifest's directory.
+    """
+    manifest_path = Path(manifest_path)
+    with open(manifest_path) as f:
+        if manifest_path.suffix.lower() in ('.yaml', '.yml'):
+            try:
+                import yaml
+            except ImportError:
+                raise ValueError("YAML manifests require PyYAML (pip install pyyaml)")
+            data = yaml.safe_load(f)
+        else:
+            data = json.load(f)
+
+    return expand_batch_jobs(data, manifest_path.parent, output_root)
+
+def expand_batch_jobs(data, base_dir, output_root):
+    """Expand parsed manifest data into (input_video, audio_file, device_type, output_dir) jobs"""
+    if not isinstance(data, dict) or not isinstance(data.get('jobs'), list):
+        raise ValueError('expected an object with a "jobs" list')
+
+    base_dir = Path(base_dir)
+    defaults = data.get('defaults', {})
+    if not isinstance(defaults, dict):
+        raise ValueError('"defaults" must be an object')
+    jobs = []
+    targets = {}
+    for index, job in enumerate(data['jobs']):
+        if not isinstance(job, dict):
+            raise ValueError(f'job {index + 1} must be an object, got {job!r}')
+        job = dict(defaults, **job)
+        name = str(job.get('name', index + 1))
+        if not job.get('audio'):
+            raise ValueError(f'job {name} has no "audio" file')
+        devices = [device for device in ('iphone', 'ipad') if job.get(device)]
+        if not devices:
+            raise ValueError(f'job {name} has neither an "iphone" nor an "ipad" video')
+
+        output_dir = base_dir / job['output'] if job.get('output') else Path(output_root) / name
+        for device_type in devices:
+            # Two builds of one device into one directory would overwrite each other's outputs
+            target = (str(output_dir.resolve()), device_type)
+            label = f'#{index + 1} ({name})'
+            if target in targets:
+                raise ValueError(f'jobs {targets[target]} and {label} both write {device_type} previews to {output_dir}; '
+                                 'give them distinct names or outputs')
+            targets[target] = label
+            jobs.append((str(base_dir / job[device_type]), str(base_dir / job['audio']), device_type, str(output_dir)))
+    return jobs
+
 def main():
     parser = argparse.ArgumentParser(description='Create App Store preview videos and screenshots')
-    parser.add_argument('--iphone', required=True, help='Input iPhone video file')
-    parser.add_argument('--ipad', required=True, help='Input iPad video file')
-    parser.add_argument('--audio', required=True, help='Input audio file (MP3)')
+    parser.add_argument('--iphone', help='Input iPhone video file')
+    parser.add_argument('--ipad', help='Input iPad video file')
+    parser.add_argument('--audio', nargs='+',
+                        help='Input audio file (MP3); with several, each gets its own previews in <output>/<name>/ '
+                             'from a single video encode per device')
     parser.add_argument('--output', default='output', help='Output directory (default: output)')
+    parser.add_argument('--manifest', help='JSON or YAML file listing many build jobs to run in one invocation')
+    parser.add_argument('--workers', type=int, default=2, help='Number of device pipelines to run concurrently (default: 2)')
+    parser.add_argument('--threads', type=int, help='CPU threads per pipeline (default: CPU count divided by workers)')
+    parser.add_argument('--screenshot-strategy', choices=['auto', 'sequential', 'seek'], default='auto',
+                        help='How screenshot frames are decoded (default: auto, chosen from the GOP structure)')
+    parser.add_argument('--single-pass', action='store_true',
+                        help='Capture screenshots in the same FFmpeg pass that encodes the preview (decodes each video once)')
+    parser.add_argument('--chunks', type=int, default=1,
+                        help='Split each preview encode into N segments encoded in parallel (default: 1)')
+    parser.add_argument('--force', action='store_true',
+                        help='Rebuild every device even if the build cache says its outputs are up to date')
+    parser.add_argument('--screenshot-workers', type=int,
+                        help='Threads resizing and encoding screenshots in parallel (default: --threads, or CPU count)')
+    parser.add_argument('--min-speed', type=float,
+                        help='Kill FFmpeg jobs whose speed stays below this realtime factor for --stall-timeout seconds')
+    parser.add_argument('--stall-timeout', type=float,
+                        help='Kill FFmpeg jobs that report no progress for this many seconds (default with --min-speed: 30)')
+    parser.add_argument('--profile', choices=list(ENCODING_PROFILES), default='final',
+                        help='Encoding profile: draft (fast, for review), final (App Store settings) '
+                             'or archival (two-pass) (default: final)')
+    parser.add_argument('--dedupe-frames', action='store_true',
+                        help='Scale only frames that differ from the previous one, then restore constant 30 fps '
+                             '(faster on mostly static recordings)')
+    parser.add_argument('--loop-memory-mb', type=int, default=LOOP_MEMORY_BUDGET // (1024 * 1024),
+                        help='Decode clips shorter than the preview once and loop the scaled frames in memory when '
+                             f'one play fits in this many MiB; 0 re-decodes each play (default: {LOOP_MEMORY_BUDGET // (1024 * 1024)})')
+    parser.add_argument('--two-pass', action='store_true',
+                        help='Encode in two passes; first-pass stats are cached, so later re-encodes at another bitrate only run the second pass')
+    parser.add_argument('--bitrate', help='Override the profile\'s target video bit rate, e.g. 10M')
+    parser.add_argument('--report', help='Write per-stage timings (wall, CPU, peak RSS, bytes written) to this JSON file')
+    parser.add_argument('--trace', help='Write per-stage timings as a Chrome trace-event file')
     
     args = parser.parse_args()
     
-    # Validate input files exist and have correct extensions
-    supported_video_extensions = ['.mov', '.m4v', '.mp4']
-    supported_audio_extensions = ['.mp3', '.wav', '.aac']
-    
-    for input_file in [args.iphone, args.ipad, args.audio]:
-        if not os.path.exists(input_file):
-            print(f"Error: Input file not found: {input_file}")
+    if args.manifest:
+        try:
+            jobs = load_batch_manifest(args.manifest, args.output)
+        except (OSError, ValueError) as e:
+            print(f"Error: Invalid manifest {args.manifest}: {e}")
             return 1
-        
-        # Check video file extensions
-        if input_file in [args.iphone, args.ipad]:
-            file_ext = os.path.splitext(input_file)[1].lower()
-            if file_ext not in supported_video_extensions:
-                print(f"Error: Unsupported video file extension: {file_ext}. Supported extensions are: {', '.join(supported_video_extensions)}")
-                return 1
-        
-        # Check audio file extensions
-        if input_file == args.audio:
-            file_ext = os.path.splitext(input_file)[1].lower()
-            if file_ext not in supported_audio_extensions:
-                print(f"Error: Unsupported audio file extension: {file_ext}. Supported extensions are: {', '.join(supported_audio_extensions)}")
-                return 1
-    
-    preview_builder = PreviewBuilder(args.output)
-    
-    # Process iPhone video
-    print("\nProcessing iPhone video...")
-    preview_builder.process_video(
-        input_video=args.iphone,
-        audio_file=args.audio,
-        device_type='iphone'
-    )
+    elif not (args.iphone and args.ipad and args.audio):
+        parser.error('--iphone, --ipad and --audio are required unless --manifest is given')
+    else:
+        jobs = [(video, audio, device_type, args.output) for audio in args.audio
+                for video, device_type in ((args.iphone, 'iphone'), (args.ipad, 'ipad'))]
+
+    # Validate input files exist and have correct extensions
+    error = validate_input_files({job[0] for job in jobs}, {job[1] for job in jobs})
+    if error:
+        print(f"Error: {error}")
+        return 1
     
-    # Process iPad video
-    print("\nProcessing iPad video...")
-    preview_builder.process_video(
-        input_video=args.ipad,
-        audio_file=args.audio,
-        device_type='ipad'
-    )
+    if args.workers < 1:
+        print("Error: --workers must be at least 1")
+        return 1
+    if args.chunks < 1:
+        print("Error: --chunks must be at least 1")
+        return 1
+
+    threads = args.threads
+    if threads is None and args.workers > 1:
+        threads = max(1, (os.cpu_count() or 1) // args.workers)
+
+    try:
+        preview_builder = PreviewBuilder(args.output, threads=threads, screenshot_strategy=args.screenshot_strategy,
+                                         single_pass=args.single_pass, screenshot_workers=args.screenshot_workers,
+                                         use_build_cache=not args.force, chunks=args.chunks,
+                                         progress_callback=print_progress, min_speed=args.min_speed,
+                                         stall_timeout=args.stall_timeout, profile=args.profile,
+                                         two_pass=args.two_pass, bitrate=args.bitrate,
+                                         dedupe_frames=args.dedupe_frames,
+                                         loop_memory_budget=args.loop_memory_mb * 1024 * 1024)
+    except ValueError as e:
+        print(f"Error: {e}")
+        return 1
     
+    try:
+        if args.manifest:
+            # One process, one builder: probes and prepared audio are shared by every job
+            print(f"Processing {len(jobs)} device jobs from {args.manifest} ({args.workers} workers)")
+            preview_builder.process_batch(jobs, workers=args.workers)
+        elif len(args.audio) > 1:
+            print(f"Building previews for {len(args.audio)} audio tracks, encoding each video once")
+            preview_builder.process_locales([(args.iphone, 'iphone'), (args.ipad, 'ipad')], args.audio,
+                                            output_dir=args.output, workers=args.workers)
+        else:
+            # Process iPhone and iPad videos, concurrently when more than one worker is allowed
+            preview_builder.process_videos(
+                jobs=[(args.iphone, 'iphone'), (args.ipad, 'ipad')],
+                audio_file=args.audio[0],
+                workers=args.workers
+            )
+    except (EncodeStalledError, ValueError) as e:
+        preview_builder.report.error = str(e)
+        print(f"Error: {e}")
+        return 1
+    except BaseException as e:
+        preview_builder.report.error = f'{type(e).__name__}: {e}'
+        raise
+    finally:
+        # Failed and stalled runs are the ones whose timings matter most
+        if args.report:
+            preview_builder.report.write_json(args.report)
+            print(f"Wrote run report: {args.report}")
+        if args.trace:
+            preview_builder.report.write_chrome_trace(args.trace)
+            print(f"Wrote Chrome trace: {args.trace}")
+
     print("\nAll processing completed successfully!")
     return 0
 
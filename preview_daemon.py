@@ -0,0 +1,369 @@
+import argparse
+import copy
+import http.client
+import itertools
+import json
+import os
+import queue
+import signal
+import socket
+import socketserver
+import sys
+import threading
+import time
+import uuid
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+from preview_builder import (ENCODING_PROFILES, PreviewBuilder, RunReport, expand_batch_jobs, print_progress,
+                             validate_input_files)
+
+DEFAULT_PORT = 8765
+
+# Finished jobs kept for status queries; older ones are forgotten first
+JOB_HISTORY = 1000
+
+
+def _now():
+    return datetime.now(timezone.utc).isoformat()
+
+
+class PreviewDaemon:
+    """Priority queue of preview jobs drained by a pool of warm worker threads
+
+    Workers share builders, so probe results, prepared audio, first-pass stats and the
+    build manifests stay cached in memory and under the output root between jobs.
+    """
+
+    def __init__(self, output_root, workers=2, **builder_kwargs):
+        self.output_root = Path(output_root)
+        self.workers = workers
+        self.builder_kwargs = builder_kwargs
+        self._builders = {}
+        self._builders_lock = threading.Lock()
+        self._audio_lock = threading.Lock()
+        self._queue = queue.PriorityQueue()
+        self._order = itertools.count()  # FIFO among jobs of equal priority
+        self._jobs = {}
+        self._jobs_lock = threading.Lock()
+        self._worker_threads = []
+
+    def builder(self, profile):
+        """One builder per encoding profile, all sharing the caches under the output root"""
+        with self._builders_lock:
+            if profile not in self._builders:
+                builder = PreviewBuilder(self.output_root, profile=profile, **self.builder_kwargs)
+                # Load the probe memo now so the per-job copies made in _work share it
+                builder._probe_memo = builder._load_probe_cache()
+                self._builders[profile] = builder
+            return self._builders[profile]
+
+    def start(self):
+        # Pay the OpenCV/NumPy import once here instead of in the first job
+        import cv2  # noqa: F401
+        import numpy  # noqa: F401
+        self.builder('final')
+        for index in range(self.workers):
+            thread = threading.Thread(target=self._work, name=f'preview-worker-{index}', daemon=True)
+            thread.start()
+            self._worker_threads.append(thread)
+
+    def stop(self):
+        """Let running jobs finish; queued jobs are dropped"""
+        for _ in self._worker_threads:
+            self._queue.put((float('-inf'), next(self._order), None, None))
+        for thread in self._worker_threads:
+            thread.join()
+        with self._jobs_lock:
+            for job in self._jobs.values():
+                if job['status'] == 'queued':
+                    job.update(status='cancelled', error='daemon stopped before the job ran', finished_at=_now())
+
+    def submit(self, request):
+        """Queue a job shaped like a batch manifest entry, plus optional "priority" and "profile"
+
+        Higher priorities run first. Relative paths are resolved against the daemon's
+        working directory.
+        """
+        if not isinstance(request, dict):
+            raise ValueError('expected a JSON object')
+        priority = int(request.get('priority', 0))
+        profile = request.get('profile', 'final')
+        if profile not in ENCODING_PROFILES:
+            raise ValueError(f"unknown profile {profile!r} (choose from {', '.join(ENCODING_PROFILES)})")
+
+        job_id = uuid.uuid4().hex[:12]
+        entry = {key: request[key] for key in ('iphone', 'ipad', 'audio', 'output') if request.get(key)}
+        entry['name'] = str(request.get('name') or job_id)
+        builds = expand_batch_jobs({'jobs': [entry]}, Path.cwd(), self.output_root)
+        error = validate_input_files({build[0] for build in builds}, {build[1] for build in builds})
+        if error:
+            raise ValueError(error)
+
+        job = {
+            'id': job_id,
+            'name': entry['name'],
+            'status': 'queued',
+            'priority': priority,
+            'profile': profile,
+            'builds': [{'device': device_type, 'video': input_video, 'audio': audio_file, 'output': output_dir}
+                       for input_video, audio_file, device_type, output_dir in builds],
+            'submitted_at': _now(),
+            'started_at': None,
+            'finished_at': None,
+            'error': None,
+            'stages': None,
+        }
+        outputs = {str(Path(output_dir).resolve()) for _, _, _, output_dir in builds}
+        with self._jobs_lock:
+            # Builds into one directory would share temp files and overwrite each other's outputs
+            for other in self._jobs.values():
+                if other['status'] in ('queued', 'running') and outputs & {
+                        str(Path(build['output']).resolve()) for build in other['builds']}:
+                    raise ValueError(f"job {other['id']} ({other['name']}) is already {other['status']} "
+                                     f"for the same output directory")
+            self._jobs[job_id] = job
+            self._forget_old_jobs()
+        self._queue.put((-priority, next(self._order), job_id, builds))
+        print(f"Queued job {job_id} ({entry['name']}, priority {priority}, {len(builds)} builds)")
+        return dict(job)
+
+    def _forget_old_jobs(self):
+        finished = [job_id for job_id, job in self._jobs.items() if job['status'] in ('done', 'failed', 'cancelled')]
+        for job_id in finished[:max(0, len(self._jobs) - JOB_HISTORY)]:
+            del self._jobs[job_id]
+
+    def job(self, job_id):
+        with self._jobs_lock:
+            job = self._jobs.get(job_id)
+            return dict(job) if job else None
+
+    def jobs(self):
+        with self._jobs_lock:
+            return [dict(job) for job in self._jobs.values()]
+
+    def health(self):
+        with self._jobs_lock:
+            counts = {}
+            for job in self._jobs.values():
+                counts[job['status']] = counts.get(job['status'], 0) + 1
+        return {'workers': self.workers, 'jobs': counts}
+
+    def _update(self, job_id, **changes):
+        with self._jobs_lock:
+            self._jobs[job_id].update(changes)
+
+    def _work(self):
+        while True:
+            _, _, job_id, builds = self._queue.get()
+            if job_id is None:
+                return
+            self._update(job_id, status='running', started_at=_now())
+            started = time.perf_counter()
+            try:
+                # A shallow copy shares the probe memo and prepared audio but gets its own
+                # report, so stage timings don't pile up on the long-lived builder
+                builder = copy.copy(self.builder(self.job(job_id)['profile']))
+                builder.report = RunReport()
+                for input_video, audio_file, device_type, output_dir in builds:
+                    # Prepared audio is written under a per-process temp name, so workers
+                    # in this process take turns encoding a new track
+                    with self._audio_lock:
+                        builder._prepare_audio(audio_file)
+                    builder.process_video(input_video, audio_file, device_type, output_dir)
+            except Exception as e:  # A failed job must not take its worker down
+                print(f"Job {job_id} failed: {e}")
+                self._update(job_id, status='failed', error=str(e), finished_at=_now())
+            else:
+                print(f"Job {job_id} done in {time.perf_counter() - started:.1f}s")
+                self._update(job_id, status='done', finished_at=_now(), stages=builder.report.summary())
+
+
+class _Handler(BaseHTTPRequestHandler):
+    """JSON API: POST /jobs, GET /jobs, GET /jobs/<id>, GET /health"""
+
+    def _send(self, status, payload):
+        body = json.dumps(payload, indent=2).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        daemon = self.server.preview_daemon
+        path = self.path.rstrip('/')
+        if path == '/health':
+            self._send(200, daemon.health())
+        elif path == '/jobs':
+            self._send(200, {'jobs': daemon.jobs()})
+        elif path.startswith('/jobs/'):
+            job = daemon.job(path[len('/jobs/'):])
+            if job:
+                self._send(200, job)
+            else:
+                self._send(404, {'error': 'no such job'})
+        else:
+            self._send(404, {'error': 'not found'})
+
+    def do_POST(self):
+        if self.path.rstrip('/') != '/jobs':
+            self._send(404, {'error': 'not found'})
+            return
+        try:
+            length = int(self.headers.get('Content-Length') or 0)
+            job = self.server.preview_daemon.submit(json.loads(self.rfile.read(length) or b'{}'))
+        except (ValueError, TypeError) as e:
+            self._send(400, {'error': str(e)})
+            return
+        self._send(202, job)
+
+    def address_string(self):
+        # Unix socket peers have no address
+        return self.client_address[0] if isinstance(self.client_address, tuple) else 'unix'
+
+
+class _UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class _UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, socket_path):
+        super().__init__('localhost')
+        self.socket_path = socket_path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(self.socket_path)
+
+
+def serve(args):
+    threads = args.threads
+    if threads is None and args.workers > 1:
+        threads = max(1, (os.cpu_count() or 1) // args.workers)
+    daemon = PreviewDaemon(args.output, workers=args.workers, threads=threads, single_pass=args.single_pass,
+                           chunks=args.chunks, progress_callback=print_progress, min_speed=args.min_speed,
+                           stall_timeout=args.stall_timeout)
+    daemon.start()
+
+    if args.socket:
+        if os.path.exists(args.socket):
+            os.unlink(args.socket)  # Left behind by a daemon that did not shut down cleanly
+        server = _UnixHTTPServer(args.socket, _Handler)
+        address = args.socket
+    else:
+        server = ThreadingHTTPServer((args.host, args.port), _Handler)
+        address = f'http://{args.host}:{args.port}'
+    server.preview_daemon = daemon
+
+    # CI runners stop services with SIGTERM; shut down the same way as Ctrl-C
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    print(f"Preview daemon listening on {address} with {args.workers} workers")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if args.socket and os.path.exists(args.socket):
+            os.unlink(args.socket)
+        print("Waiting for running jobs to finish...")
+        daemon.stop()
+    return 0
+
+
+def _request(args, method, path, payload=None):
+    if args.socket:
+        connection = _UnixHTTPConnection(args.socket)
+    else:
+        connection = http.client.HTTPConnection(args.host, args.port)
+    try:
+        body = json.dumps(payload).encode() if payload is not None else None
+        connection.request(method, path, body=body, headers={'Content-Type': 'application/json'})
+        response = connection.getresponse()
+        return response.status, json.loads(response.read() or b'{}')
+    finally:
+        connection.close()
+
+
+def submit(args):
+    # The daemon resolves relative paths against its own directory, so send absolute ones
+    request = {key: os.path.abspath(value) for key, value in
+               (('iphone', args.iphone), ('ipad', args.ipad), ('audio', args.audio), ('output', args.output))
+               if value}
+    request.update({'priority': args.priority, 'profile': args.profile})
+    if args.name:
+        request['name'] = args.name
+    status, job = _request(args, 'POST', '/jobs', request)
+    if status != 202:
+        print(f"Error: {job.get('error', status)}")
+        return 1
+    print(f"Submitted job {job['id']}")
+    if not args.wait:
+        return 0
+
+    while job['status'] in ('queued', 'running'):
+        time.sleep(args.poll_interval)
+        _, job = _request(args, 'GET', f"/jobs/{job['id']}")
+    if job['status'] == 'failed':
+        print(f"Error: Job {job['id']} failed: {job['error']}")
+        return 1
+    print(f"Job {job['id']} done")
+    return 0
+
+
+def status(args):
+    status_code, data = _request(args, 'GET', f'/jobs/{args.job_id}' if args.job_id else '/jobs')
+    print(json.dumps(data, indent=2))
+    return 0 if status_code == 200 else 1
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Long-running daemon that builds previews for submitted jobs')
+    connection = argparse.ArgumentParser(add_help=False)
+    connection.add_argument('--host', default='127.0.0.1', help='Address of the HTTP API (default: 127.0.0.1)')
+    connection.add_argument('--port', type=int, default=DEFAULT_PORT, help=f'Port of the HTTP API (default: {DEFAULT_PORT})')
+    connection.add_argument('--socket', help='Serve on / connect to this Unix socket instead of TCP')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    serve_parser = subparsers.add_parser('serve', parents=[connection], help='Run the daemon')
+    serve_parser.add_argument('--output', default='output',
+                              help='Output root for jobs without an "output" and for the shared caches (default: output)')
+    serve_parser.add_argument('--workers', type=int, default=2, help='Jobs built concurrently (default: 2)')
+    serve_parser.add_argument('--threads', type=int, help='CPU threads per job (default: CPU count divided by workers)')
+    serve_parser.add_argument('--single-pass', action='store_true', help='Capture screenshots in the preview encode')
+    serve_parser.add_argument('--chunks', type=int, default=1, help='Parallel segments per preview encode (default: 1)')
+    serve_parser.add_argument('--min-speed', type=float, help='Kill FFmpeg jobs slower than this realtime factor')
+    serve_parser.add_argument('--stall-timeout', type=float, help='Kill FFmpeg jobs silent for this many seconds')
+
+    submit_parser = subparsers.add_parser('submit', parents=[connection], help='Queue a job on a running daemon')
+    submit_parser.add_argument('--iphone', help='Input iPhone video file')
+    submit_parser.add_argument('--ipad', help='Input iPad video file')
+    submit_parser.add_argument('--audio', required=True, help='Input audio file')
+    submit_parser.add_argument('--output', help='Output directory (default: <daemon output root>/<name>)')
+    submit_parser.add_argument('--name', help='Job name (default: the job id)')
+    submit_parser.add_argument('--priority', type=int, default=0, help='Higher priorities run first (default: 0)')
+    submit_parser.add_argument('--profile', choices=list(ENCODING_PROFILES), default='final',
+                               help='Encoding profile (default: final)')
+    submit_parser.add_argument('--wait', action='store_true', help='Block until the job finishes; exit 1 if it fails')
+    submit_parser.add_argument('--poll-interval', type=float, default=1.0, help='Seconds between status polls with --wait')
+
+    status_parser = subparsers.add_parser('status', parents=[connection], help='Show one job or all jobs')
+    status_parser.add_argument('job_id', nargs='?', help='Job id (default: list every job)')
+
+    args = parser.parse_args()
+    if args.command == 'serve':
+        if args.workers < 1:
+            print("Error: --workers must be at least 1")
+            return 1
+        return serve(args)
+    try:
+        return submit(args) if args.command == 'submit' else status(args)
+    except OSError as e:
+        print(f"Error: Cannot reach the preview daemon: {e}")
+        return 1
+
+
+if __name__ == "__main__":
+    exit(main())